@@ -1,14 +1,24 @@
 import os
+import json
+import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from datetime import datetime
 from elasticsearch import Elasticsearch, NotFoundError
 from dotenv import load_dotenv
+from rich.console import Group
+from rich.live import Live
+from rich.table import Table
+from rich.text import Text
 
 # Load environment variables
 load_dotenv()
 
 # Elasticsearch client setup
+# ELASTIC_URL is used when CLOUD_ID is empty, e.g. for a self-managed cluster
 es = Elasticsearch(
-    cloud_id=os.getenv("CLOUD_ID"),
+    **({"cloud_id": os.getenv("CLOUD_ID")} if os.getenv("CLOUD_ID") else {"hosts": os.getenv("ELASTIC_URL")}),
     api_key=os.getenv("API_KEY")
 )
 
@@ -32,6 +42,39 @@ models = {
     }
 }
 
+# Deployment settings per model. Allocations add throughput (requests inferred in parallel), threads per
+# allocation lower the latency of each request, and queue_capacity bounds how many requests can wait.
+# Low priority deployments must use one allocation with one thread. adaptive_allocations lets the cluster
+# scale between min and max allocations with load, instead of a fixed number_of_allocations.
+LOW_PRIORITY = {"number_of_allocations": 1, "threads_per_allocation": 1, "priority": "low"}
+DEPLOYMENT_PROFILES = {
+    "default": {},
+    "search": {
+        "elser": {"number_of_allocations": 1, "threads_per_allocation": 4, "queue_capacity": 1024, "priority": "normal"},
+        "ner": LOW_PRIORITY,
+        "sentiment": LOW_PRIORITY,
+        "zero_shot": LOW_PRIORITY
+    },
+    "ingest": {
+        "elser": {"number_of_allocations": 4, "threads_per_allocation": 1, "queue_capacity": 10000, "priority": "normal"},
+        "ner": LOW_PRIORITY,
+        "sentiment": LOW_PRIORITY,
+        "zero_shot": LOW_PRIORITY
+    },
+    "adaptive": {
+        "elser": {"threads_per_allocation": 1, "queue_capacity": 10000, "adaptive_allocations": {"enabled": True, "min_number_of_allocations": 1, "max_number_of_allocations": 8}},
+        "ner": {"adaptive_allocations": {"enabled": True, "min_number_of_allocations": 0, "max_number_of_allocations": 2}},
+        "sentiment": {"adaptive_allocations": {"enabled": True, "min_number_of_allocations": 0, "max_number_of_allocations": 2}},
+        "zero_shot": {"adaptive_allocations": {"enabled": True, "min_number_of_allocations": 0, "max_number_of_allocations": 2}}
+    }
+}
+
+def load_profile(profile_name, profile_file=None):
+    if profile_file:
+        with open(profile_file, 'r') as file:
+            return json.load(file)
+    return DEPLOYMENT_PROFILES[profile_name]
+
 def is_model_installed(model_name):
     try:
         es.ml.get_trained_models(model_id=model_name)
@@ -39,20 +82,95 @@ def is_model_installed(model_name):
     except NotFoundError:
         return False
 
-def deploy_model(model_key):
+def deployment_stats(model_names):
+    # One request per model: a single missing model would fail a comma-joined request for all of them.
+    # Models that aren't installed are left out, undeployed ones map to None.
+    result = {}
+    for model_name in model_names:
+        try:
+            response = es.ml.get_trained_models_stats(model_id=model_name)
+        except NotFoundError:
+            continue
+        for stats in response["trained_model_stats"]:
+            result[stats["model_id"]] = stats.get("deployment_stats")
+    return result
+
+def wait_until_defined(model_name, timeout):
+    # Elastic-provided models such as ELSER are downloaded after put_trained_model and can't be started before
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        config = es.ml.get_trained_models(model_id=model_name, include="definition_status")["trained_model_configs"][0]
+        if config.get("fully_defined"):
+            return True
+        time.sleep(5)
+    return False
+
+def start_deployment(model_key, settings):
     model = models[model_key]
+    params = {key: value for key, value in settings.items() if key != "adaptive_allocations"}
+    if "adaptive_allocations" in settings:
+        # The client doesn't expose adaptive_allocations yet; allocations are then managed by the cluster
+        params.pop("number_of_allocations", None)
+        es.perform_request(
+            "POST",
+            f"/_ml/trained_models/{model['name']}/deployment/_start",
+            params=dict(params, wait_for="starting"),
+            headers={"accept": "application/json", "content-type": "application/json"},
+            body={"adaptive_allocations": settings["adaptive_allocations"]}
+        )
+    else:
+        es.ml.start_trained_model_deployment(model_id=model["name"], wait_for="starting", **params)
+
+def update_deployment(model_key, settings):
+    # Only the allocations of a running deployment can change; threads, queue and priority need a restart
+    model = models[model_key]
+    if "adaptive_allocations" in settings:
+        es.ml.update_trained_model_deployment(model_id=model["name"], body={"adaptive_allocations": settings["adaptive_allocations"]})
+    elif "number_of_allocations" in settings:
+        es.ml.update_trained_model_deployment(model_id=model["name"], number_of_allocations=settings["number_of_allocations"])
+
+def deploy_model(model_key, settings=None, timeout=1200):
+    model = models[model_key]
+    settings = settings or {}
     print(f"Deploying {model_key.upper()} model...")
     try:
-        es.ml.put_trained_model(
-            model_id=model["name"],
-            inference_config={model["type"]: {}},
-            input={"field_names": ["text_field"]},
-            description=f"{model_key.upper()} model"
-        )
-        es.ml.start_trained_model_deployment(model_id=model["name"])
-        print(f"{model_key.upper()} model deployed successfully.")
+        if not is_model_installed(model["name"]):
+            es.ml.put_trained_model(
+                model_id=model["name"],
+                inference_config={model["type"]: {}},
+                input={"field_names": ["text_field"]},
+                description=f"{model_key.upper()} model"
+            )
+        if not wait_until_defined(model["name"], timeout):
+            print(f"Error deploying {model_key.upper()} model: model definition not ready after {timeout}s")
+            return False
+        start_deployment(model_key, settings)
+        print(f"{model_key.upper()} model deployment started with {settings or 'default settings'}.")
+        return True
     except Exception as e:
         print(f"Error deploying {model_key.upper()} model: {str(e)}")
+        return False
+
+def wait_for_allocation(model_keys, timeout=1200, poll_interval=5):
+    # A deployment only serves at full capacity once every allocation is assigned to a node
+    pending = {models[key]["name"]: key for key in model_keys}
+    deadline = time.time() + timeout
+    while pending:
+        for model_name, stats in deployment_stats(list(pending)).items():
+            stats = stats or {}
+            allocation = stats.get("allocation_status", {})
+            adaptive = stats.get("adaptive_allocations") or {}
+            # Adaptive deployments may legitimately sit below target, so they're ready once their minimum is allocated
+            adaptive_ready = adaptive.get("enabled") and stats.get("state") == "started" and allocation.get("allocation_count", 0) >= adaptive.get("min_number_of_allocations", 0)
+            if allocation.get("state") == "fully_allocated" or adaptive_ready:
+                print(f"{pending.pop(model_name).upper()} model is ready ({allocation.get('allocation_count', 0)}/{allocation.get('target_allocation_count', 0)} allocations).")
+            elif time.time() >= deadline:
+                print(f"{pending[model_name].upper()} model is not fully allocated after {timeout}s "
+                      f"({allocation.get('allocation_count', 0)}/{allocation.get('target_allocation_count', 0)} allocations, state {stats.get('state')}).")
+        if not pending or time.time() >= deadline:
+            break
+        time.sleep(poll_interval)
+    return not pending
 
 def remove_model(model_key):
     model = models[model_key]
@@ -64,14 +182,37 @@ def remove_model(model_key):
     except Exception as e:
         print(f"Error removing {model_key.upper()} model: {str(e)}")
 
-def check_and_deploy_models():
+def check_and_deploy_models(profile=None, timeout=1200):
     print("Checking model status and deploying missing models...")
+    profile = profile or {}
+    started = []
+    to_deploy = []
     for model_key, model in models.items():
+        settings = profile.get(model_key, {})
         if not is_model_installed(model["name"]):
             print(f"{model_key.upper()} model is not installed. Deploying...")
-            deploy_model(model_key)
+            to_deploy.append(model_key)
+        elif not deployment_stats([model["name"]]).get(model["name"]):
+            print(f"{model_key.upper()} model is installed but not deployed. Deploying...")
+            to_deploy.append(model_key)
         else:
             print(f"{model_key.upper()} model is already installed.")
+            if settings:
+                try:
+                    update_deployment(model_key, settings)
+                    print(f"{model_key.upper()} model deployment updated.")
+                except Exception as e:
+                    print(f"Error updating {model_key.upper()} model deployment: {str(e)}")
+            started.append(model_key)
+
+    # Downloads and deployments run side by side, so the slowest model (usually ELSER) sets the total time
+    if to_deploy:
+        with ThreadPoolExecutor(max_workers=len(to_deploy)) as executor:
+            results = executor.map(lambda key: deploy_model(key, profile.get(key), timeout), to_deploy)
+            started.extend(key for key, ok in zip(to_deploy, results) if ok)
+
+    if started and wait_for_allocation(started, timeout):
+        print("All deployed models are fully allocated.")
 
 def check_models():
     print("Checking model status...")
@@ -97,24 +238,161 @@ def check_models():
     else:
         print("All models are installed.")
 
+def deployment_metrics(stats, previous=None):
+    nodes = stats.get("nodes", [])
+    allocation = stats.get("allocation_status", {})
+    inference_count = sum(node.get("inference_count", 0) for node in nodes)
+    total_time = sum(node.get("inference_count", 0) * node.get("average_inference_time_ms", 0) for node in nodes)
+    metrics = {
+        "state": stats.get("state", "-"),
+        "allocations": allocation.get("allocation_count", 0),
+        "target_allocations": allocation.get("target_allocation_count", stats.get("number_of_allocations", 0)),
+        "threads": stats.get("threads_per_allocation", 0),
+        "priority": stats.get("priority", "normal"),
+        "adaptive": bool((stats.get("adaptive_allocations") or {}).get("enabled")),
+        "inference_count": inference_count,
+        "total_time_ms": total_time,
+        "average_ms": total_time / inference_count if inference_count else 0,
+        "queue": sum(node.get("number_of_pending_requests", 0) for node in nodes),
+        "rejected": sum(node.get("rejected_execution_count", 0) for node in nodes),
+        "timeouts": sum(node.get("timeout_count", 0) for node in nodes),
+        "time": time.time()
+    }
+    # The stats are cumulative since the deployment started, so rates and recent latency come from the deltas
+    if previous:
+        inferences = inference_count - previous["inference_count"]
+        metrics["rate"] = inferences / max(metrics["time"] - previous["time"], 1e-9)
+        metrics["recent_ms"] = (total_time - previous["total_time_ms"]) / inferences if inferences > 0 else 0
+        metrics["new_rejected"] = max(0, metrics["rejected"] - previous["rejected"])
+    else:
+        metrics["rate"] = 0
+        metrics["recent_ms"] = metrics["average_ms"]
+        metrics["new_rejected"] = 0
+    return metrics
+
+def autoscale_decision(metrics, policy, quiet_polls):
+    # Returns the number of allocations to move to, or None to leave the deployment alone
+    if metrics["adaptive"] or metrics["priority"] == "low" or metrics["state"] != "started":
+        return None
+    current = metrics["target_allocations"]
+    overloaded = metrics["queue"] > policy["queue_high"] or metrics["recent_ms"] > policy["latency_high_ms"] or metrics["new_rejected"] > 0
+    if overloaded and current < policy["max_allocations"]:
+        return current + 1
+    # Scale down only after the deployment has stayed quiet for a while, so a pause between bulk requests doesn't count
+    if quiet_polls >= policy["quiet_polls"] and current > policy["min_allocations"]:
+        return current - 1
+    return None
+
+def monitor_table(rows):
+    table = Table(title=f"Trained model deployments ({datetime.now():%H:%M:%S})")
+    for column in ["Model", "State", "Allocations", "Threads", "Inferences", "Rate/s", "Avg ms", "Recent ms", "Queue", "Rejected", "Timeouts"]:
+        table.add_column(column, justify="left" if column in ("Model", "State") else "right")
+    for model_key, metrics in rows:
+        if isinstance(metrics, str):
+            table.add_row(model_key.upper(), metrics, *["-"] * 9)
+            continue
+        allocations = f"{metrics['allocations']}/{metrics['target_allocations']}{' (adaptive)' if metrics['adaptive'] else ''}"
+        table.add_row(
+            model_key.upper(), metrics["state"], allocations, str(metrics["threads"]), str(metrics["inference_count"]),
+            f"{metrics['rate']:.1f}", f"{metrics['average_ms']:.1f}", f"{metrics['recent_ms']:.1f}",
+            Text(str(metrics["queue"]), style="red" if metrics["queue"] else ""),
+            Text(str(metrics["rejected"]), style="red" if metrics["new_rejected"] else ""),
+            str(metrics["timeouts"])
+        )
+    return table
+
+def monitor_models(interval=10, policy=None):
+    # Polls deployment stats for every model and, with a policy, steps allocations up under load and back down when idle
+    previous = {}
+    quiet_polls = {}
+    last_change = {}
+    events = deque(maxlen=10)
+    names = {model["name"]: model_key for model_key, model in models.items()}
+
+    with Live(auto_refresh=False) as live:
+        try:
+            while True:
+                try:
+                    stats_by_name = deployment_stats(list(names))
+                except Exception as e:
+                    stats_by_name = {}
+                    events.append(f"{datetime.now():%H:%M:%S} Error reading deployment stats: {str(e)}")
+
+                rows = []
+                for model_name, model_key in names.items():
+                    stats = stats_by_name.get(model_name)
+                    if not stats:
+                        previous.pop(model_key, None)
+                        rows.append((model_key, "not deployed" if model_name in stats_by_name else "not installed"))
+                        continue
+                    metrics = deployment_metrics(stats, previous.get(model_key))
+                    previous[model_key] = metrics
+                    rows.append((model_key, metrics))
+
+                    if not policy:
+                        continue
+                    quiet = metrics["queue"] == 0 and metrics["new_rejected"] == 0 and metrics["recent_ms"] < policy["latency_high_ms"] / 2
+                    quiet_polls[model_key] = quiet_polls.get(model_key, 0) + 1 if quiet else 0
+                    # Allocations take a while to start, so give each change time to show up in the stats
+                    if time.time() - last_change.get(model_key, 0) < policy["cooldown"]:
+                        continue
+                    allocations = autoscale_decision(metrics, policy, quiet_polls[model_key])
+                    if allocations is None:
+                        continue
+                    try:
+                        es.ml.update_trained_model_deployment(model_id=model_name, number_of_allocations=allocations)
+                        events.append(f"{datetime.now():%H:%M:%S} {model_key.upper()}: {metrics['target_allocations']} -> {allocations} allocations "
+                                      f"(queue {metrics['queue']}, recent {metrics['recent_ms']:.0f} ms, {metrics['new_rejected']} new rejections)")
+                    except Exception as e:
+                        events.append(f"{datetime.now():%H:%M:%S} Error scaling {model_key.upper()}: {str(e)}")
+                    last_change[model_key] = time.time()
+                    quiet_polls[model_key] = 0
+
+                live.update(Group(monitor_table(rows), Text("\n".join(events))), refresh=True)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
 def main():
     parser = argparse.ArgumentParser(description="Manage ML models in Elasticsearch")
     parser.add_argument("--deploy", action="store_true", help="Check and deploy missing models")
     parser.add_argument("--remove", action="store_true", help="Remove all models")
     parser.add_argument("--check", action="store_true", help="Check which models are installed")
+    parser.add_argument("--profile", choices=DEPLOYMENT_PROFILES, default="default", help="Deployment settings for --deploy: allocations, threads, queue capacity, priority and adaptive allocations per model")
+    parser.add_argument("--profile-file", type=str, help="JSON file with per-model deployment settings, in the same shape as the built-in profiles")
+    parser.add_argument("--timeout", type=int, default=1200, help="Seconds to wait for models to download and become fully allocated")
+    parser.add_argument("--monitor", action="store_true", help="Show live inference stats for every deployed model")
+    parser.add_argument("--interval", type=float, default=10, help="Seconds between --monitor polls")
+    parser.add_argument("--autoscale", action="store_true", help="With --monitor, add an allocation when queue depth, latency or rejections cross the thresholds and remove one when idle")
+    parser.add_argument("--min-allocations", type=int, default=1, help="Lowest number of allocations --autoscale scales down to")
+    parser.add_argument("--max-allocations", type=int, default=8, help="Highest number of allocations --autoscale scales up to")
+    parser.add_argument("--queue-high", type=int, default=100, help="Pending inference requests that trigger a scale up")
+    parser.add_argument("--latency-high-ms", type=float, default=1000, help="Recent average inference time in ms that triggers a scale up")
+    parser.add_argument("--quiet-polls", type=int, default=6, help="Consecutive quiet polls before --autoscale removes an allocation")
+    parser.add_argument("--cooldown", type=float, default=120, help="Seconds to wait after scaling a model before scaling it again")
     args = parser.parse_args()
 
-    if sum([args.deploy, args.remove, args.check]) != 1:
-        print("Error: Please specify exactly one of --deploy, --remove, or --check flags.")
+    if sum([args.deploy, args.remove, args.check, args.monitor]) != 1:
+        print("Error: Please specify exactly one of --deploy, --remove, --check, or --monitor flags.")
         return
 
     if args.deploy:
-        check_and_deploy_models()
+        check_and_deploy_models(load_profile(args.profile, args.profile_file), args.timeout)
     elif args.remove:
         for model in models:
             remove_model(model)
     elif args.check:
         check_models()
+    elif args.monitor:
+        policy = {
+            "min_allocations": args.min_allocations,
+            "max_allocations": args.max_allocations,
+            "queue_high": args.queue_high,
+            "latency_high_ms": args.latency_high_ms,
+            "quiet_polls": args.quiet_polls,
+            "cooldown": args.cooldown
+        } if args.autoscale else None
+        monitor_models(args.interval, policy)
 
 if __name__ == "__main__":
     main()
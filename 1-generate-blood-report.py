@@ -1,149 +1,141 @@
 import random
 import csv
-import string
-import requests
 import argparse
 import os
-from datetime import datetime
+import io
+from multiprocessing import Pool
 from reportlab.lib.pagesizes import letter
 from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, TableStyle, Spacer, Image
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfbase import pdfmetrics
+from PIL import Image as PILImage
+from identity import draw_identities
+from blood_samples import BLOOD_PARAMETERS, LAB_LOCATIONS, iter_sample_batches
 
 # Register DejaVuSans font
 pdfmetrics.registerFont(TTFont('DejaVuSans', 'artefacts/DejaVuSans.ttf'))
 
-class BloodParameter:
-    def __init__(self, name, unit, lower_bound, upper_bound):
-        self.name = name
-        self.unit = unit
-        self.lower_bound = lower_bound
-        self.upper_bound = upper_bound
-
-    def generate_random_value(self, percentage_min, percentage_max):
-        range_extension = (self.upper_bound - self.lower_bound) * (random.uniform(percentage_min, percentage_max) / 100)
-        extended_lower_bound = self.lower_bound - range_extension
-        extended_upper_bound = self.upper_bound + range_extension
-        return random.uniform(extended_lower_bound, extended_upper_bound)
-
-    def is_within_range(self, value):
-        return self.lower_bound <= value <= self.upper_bound
-
-def generate_report(parameters, measurements, silent=False):
+def generate_report(parameters, measurements, within_range, silent=False):
     report = ""
     for param in parameters:
         value = measurements[param.name]
         ref_range = f"({param.lower_bound} - {param.upper_bound})"
         if not silent:
-            within_range = param.is_within_range(value)
-            status = "within range" if within_range else "out of range"
+            status = "within range" if within_range[param.name] else "out of range"
             report += f"{param.name} ({param.unit}): {value:.2f} {ref_range} - {status}\n"
         else:
             report += f"{param.name} ({param.unit}): {value:.2f} {ref_range}\n"
     return report
 
-def generate_samples(parameters, num_samples, percentage_min, percentage_max):
-    samples = []
-    for _ in range(num_samples):
-        measurements = {param.name: param.generate_random_value(percentage_min, percentage_max) for param in parameters}
-        samples.append(measurements)
-    return samples
-
-def get_random_user():
-    response = requests.get('https://randomuser.me/api/?nat=nz')
-    if response.status_code == 200:
-        user_data = response.json()['results'][0]
-        full_name = f"{user_data['name']['first']} {user_data['name']['last']}"
-        address = f"{user_data['location']['street']['number']} {user_data['location']['street']['name']}, {user_data['location']['city']}, {user_data['location']['postcode']}, {user_data['location']['state']}, New Zealand"
-        sex = user_data['gender']
-        age = user_data['dob']['age']
-        dob = user_data['dob']['date'].split('T')[0]
-        return full_name, address, sex, age, dob
-    else:
-        return "John Doe", "123 Fake Street, Faketown, 0000, FakeState, New Zealand", "male", 30, "1981-01-01"
-
-def generate_nhi():
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=7))
-
 def get_lab_location():
-    nz_cities = ["Auckland", "Wellington", "Christchurch", "Hamilton", "Tauranga", "Napier-Hastings", "Dunedin", "Palmerston North", "Nelson", "Rotorua"]
-    return random.choice(nz_cities)
-
-def generate_lab_number():
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
-
-def save_as_pdf(patient, samples, parameters, output_dir):
+    return random.choice(LAB_LOCATIONS)
+
+# Number of reports queued per worker before they are handed to the process pool
+PDF_JOBS_PER_WORKER = 64
+PDF_CHUNK_SIZE = 8
+# The logo is drawn at 50x50pt, so a 200px copy keeps ~290 dpi instead of embedding the 1920px original each time
+LOGO_PIXELS = 200
+
+# Styles, table style and logo are loaded once per process and reused for every report
+pdf_resources = None
+
+def load_pdf_resources():
+    global pdf_resources
+    if pdf_resources is None:
+        logo = io.BytesIO()
+        with PILImage.open("artefacts/logo.jpg") as image:
+            image.convert("RGB").resize((LOGO_PIXELS, LOGO_PIXELS), PILImage.LANCZOS).save(logo, format="JPEG", quality=90)
+        pdf_resources = {
+            "styles": getSampleStyleSheet(),
+            "table_style": TableStyle([
+                ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+                ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+                ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+                ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+                ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+                ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+                ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ]),
+            "logo": logo.getvalue()
+        }
+    return pdf_resources
+
+def report_file_name(patient_number, patient, index, year, output_dir, extension):
+    # Names aren't unique, so the patient's position in the run keeps two patients' reports (and workers) apart
+    return f"{output_dir}/Report_{patient_number}_{patient[0].replace(' ', '_')}_{index}_{year}.{extension}"
+
+def render_pdf_report(job):
+    file_name, patient, sample, parameters = job
     full_name, address, nhi, sex, age, dob, lab = patient
-    for i, (year, measurements, collection_date, lab_number) in enumerate(samples):
-        report = generate_report(parameters, measurements)
-        file_name = f"{output_dir}/Report_{full_name.replace(' ', '_')}_{i+1}_{year}.pdf"
-        doc = SimpleDocTemplate(file_name, pagesize=letter)
-        elements = []
-
-        # Add Lab logo and address on the same row
-        table_data = [[
-            Image("artefacts/logo.jpg", width=50, height=50),
-            Paragraph("Random Lab<br/>PO Box 12345, Faketown, New Zealand", getSampleStyleSheet()["Normal"])
-        ]]
-        logo_address_table = Table(table_data, colWidths=[60, 400])
-        elements.append(logo_address_table)
-        elements.append(Spacer(1, 12))
-
-        # Patient info table
-        patient_data = [
-            ["Patient:", full_name, "NHI:", nhi],
-            ["Address:", address, "Sex:", sex],
-            ["Age:", f"{age} years", "Date of birth:", dob],
-            ["Lab:", lab, "", ""]
-        ]
-        table = Table(patient_data)
-        table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ]))
-        elements.append(table)
-        elements.append(Spacer(1, 12))
-
-        # Blood count heading
-        elements.append(Paragraph("<b>BLOOD COUNT</b>", getSampleStyleSheet()["Title"]))
-        elements.append(Spacer(1, 12))
-
-        # Collection Date and Lab Number
-        elements.append(Paragraph(f"Date: {collection_date}", getSampleStyleSheet()["Normal"]))
-        elements.append(Paragraph(f"Lab Numbers: {lab_number}", getSampleStyleSheet()["Normal"]))
-        elements.append(Spacer(1, 12))
-
-        # Blood parameters table
-        data = [["Parameter", "Measurement", "Ref. Range"]]
-        for param in parameters:
-            data.append([param.name, f"{measurements[param.name]:.2f} {param.unit}", f"{param.lower_bound} - {param.upper_bound}"])
-        blood_table = Table(data)
-        blood_table.setStyle(TableStyle([
-            ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-            ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-            ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-            ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ]))
-        elements.append(blood_table)
-
-        # Build PDF
-        doc.build(elements)
+    year, measurements, within_range, collection_date, lab_number = sample
+    resources = load_pdf_resources()
+    styles = resources["styles"]
+
+    doc = SimpleDocTemplate(file_name, pagesize=letter)
+    elements = []
+
+    # Add Lab logo and address on the same row
+    table_data = [[
+        Image(io.BytesIO(resources["logo"]), width=50, height=50),
+        Paragraph("Random Lab<br/>PO Box 12345, Faketown, New Zealand", styles["Normal"])
+    ]]
+    logo_address_table = Table(table_data, colWidths=[60, 400])
+    elements.append(logo_address_table)
+    elements.append(Spacer(1, 12))
+
+    # Patient info table
+    patient_data = [
+        ["Patient:", full_name, "NHI:", nhi],
+        ["Address:", address, "Sex:", sex],
+        ["Age:", f"{age} years", "Date of birth:", dob],
+        ["Lab:", lab, "", ""]
+    ]
+    table = Table(patient_data)
+    table.setStyle(resources["table_style"])
+    elements.append(table)
+    elements.append(Spacer(1, 12))
+
+    # Blood count heading
+    elements.append(Paragraph("<b>BLOOD COUNT</b>", styles["Title"]))
+    elements.append(Spacer(1, 12))
+
+    # Collection Date and Lab Number
+    elements.append(Paragraph(f"Date: {collection_date}", styles["Normal"]))
+    elements.append(Paragraph(f"Lab Numbers: {lab_number}", styles["Normal"]))
+    elements.append(Spacer(1, 12))
+
+    # Blood parameters table
+    data = [["Parameter", "Measurement", "Ref. Range"]]
+    for param in parameters:
+        data.append([param.name, f"{measurements[param.name]:.2f} {param.unit}", f"{param.lower_bound} - {param.upper_bound}"])
+    blood_table = Table(data)
+    blood_table.setStyle(resources["table_style"])
+    elements.append(blood_table)
+
+    # Build PDF
+    doc.build(elements)
+    return file_name
+
+def pdf_jobs(patient_number, patient, samples, parameters, output_dir):
+    for i, sample in enumerate(samples):
+        yield report_file_name(patient_number, patient, i + 1, sample[0], output_dir, "pdf"), patient, sample, parameters
+
+def save_as_pdf(patient_number, patient, samples, parameters, output_dir):
+    for job in pdf_jobs(patient_number, patient, samples, parameters, output_dir):
+        file_name = render_pdf_report(job)
+        print(f"Report saved as {file_name}")
+
+def render_pdf_jobs(pool, jobs):
+    # imap keeps results in submission order, so output is identical to a serial run
+    for file_name in pool.imap(render_pdf_report, jobs, chunksize=PDF_CHUNK_SIZE):
         print(f"Report saved as {file_name}")
 
-def save_as_csv(patient, samples, parameters, output_dir):
+def save_as_csv(patient_number, patient, samples, parameters, output_dir):
     full_name, address, nhi, sex, age, dob, lab = patient
-    for i, (year, measurements, collection_date, lab_number) in enumerate(samples):
-        file_name = f"{output_dir}/Report_{full_name.replace(' ', '_')}_{i+1}_{year}.csv"
+    for i, (year, measurements, within_range, collection_date, lab_number) in enumerate(samples):
+        file_name = report_file_name(patient_number, patient, i + 1, year, output_dir, "csv")
         with open(file_name, mode='w', newline='') as file:
             writer = csv.writer(file)
             writer.writerow(["Patient", full_name, "NHI", nhi])
@@ -160,54 +152,62 @@ def save_as_csv(patient, samples, parameters, output_dir):
                 writer.writerow([param.name, f"{measurements[param.name]:.2f} {param.unit}", f"{param.lower_bound} - {param.upper_bound}"])
         print(f"Report saved as {file_name}")
 
-def main(patients, samples, start_year, end_year, percentage_min, percentage_max, silent, to_pdf, to_csv, output_dir):
+def main(patients, samples, start_year, end_year, percentage_min, percentage_max, silent, to_pdf, to_csv, output_dir, seed=None, identity_pool=None, workers=1, patients_per_batch=10000):
     # Create the output directory if it doesn't exist
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
         print(f"Created output directory: {output_dir}")
 
-    parameters = [
-        BloodParameter("Haemoglobin", "g/L", 130, 175),
-        BloodParameter("RBC", "x10¹²/L", 4.30, 6.00),
-        BloodParameter("HCT", "N/A", 0.40, 0.52),
-        BloodParameter("MCV", "fL", 80, 99),
-        BloodParameter("MCH", "pg", 27, 33.0),
-        BloodParameter("Platelets", "x10⁹/L", 150, 400),
-        BloodParameter("WBC", "x10⁹/L", 4.0, 11.0),
-        BloodParameter("Neutrophils", "x10⁹/L", 1.90, 7.50),
-        BloodParameter("Lymphocytes", "x10⁹/L", 1.00, 4.00),
-        BloodParameter("Monoocytes", "x10⁹/L", 0.20, 1.00),
-        BloodParameter("Eosinophils", "x10⁹/L", 0.00, 0.51),
-        BloodParameter("Basophils", "x10⁹/L", 0.00, 0.20)
-    ]
-
-    for _ in range(patients):
-        full_name, address, sex, age, dob = get_random_user()
-        nhi = generate_nhi()
-        lab = get_lab_location()
-        patient = (full_name, address, nhi, sex, age, dob, lab)
-
-        samples_data = []
-        for year in range(start_year, end_year + 1):
-            measurements = generate_samples(parameters, samples, percentage_min, percentage_max)
-            for measurement in measurements:
-                collection_date = datetime(year, random.randint(1, 12), random.randint(1, 28)).strftime('%d/%m/%Y')
-                lab_number = generate_lab_number()
-                samples_data.append((year, measurement, collection_date, lab_number))
-
-        if to_pdf:
-            save_as_pdf(patient, samples_data, parameters, output_dir)
-
-        if to_csv:
-            save_as_csv(patient, samples_data, parameters, output_dir)
-
-        if not to_pdf and not to_csv:
-            for year, measurements, collection_date, lab_number in samples_data:
-                report = generate_report(parameters, measurements, silent)
-                print(f"Patient: {full_name}\nNHI: {nhi}\nAddress: {address}\nSex: {sex}\nAge: {age} years\nDate of birth: {dob}\nLab: {lab}")
-                print("\nBLOOD COUNT\n")
-                print(f"Date: {collection_date}\nLab Numbers: {lab_number}\n")
-                print(report)
+    parameters = BLOOD_PARAMETERS
+
+    if seed is not None:
+        random.seed(seed)
+
+    identities = draw_identities(patients, seed=seed, pool_path=identity_pool)
+
+    # All random data is drawn in this process, workers only render, so a seeded run is deterministic
+    pool = Pool(workers, initializer=load_pdf_resources) if to_pdf and workers > 1 else None
+    pending_jobs = []
+
+    # Every measurement, collection date and lab number for a block of patients is drawn in one vectorized batch
+    sample_batches = iter_sample_batches(parameters, patients, start_year, end_year, samples, percentage_min, percentage_max, seed, patients_per_batch)
+    identity_iter = iter(identities)
+    patient_number = 0
+
+    try:
+        for batch in sample_batches:
+            for patient_index in range(batch.num_patients):
+                full_name, address, sex, age, dob, nhi = next(identity_iter)
+                patient_number += 1
+                lab = get_lab_location()
+                patient = (full_name, address, nhi, sex, age, dob, lab)
+                samples_data = batch.patient_samples(patient_index)
+
+                if to_pdf and pool:
+                    pending_jobs.extend(pdf_jobs(patient_number, patient, samples_data, parameters, output_dir))
+                    if len(pending_jobs) >= workers * PDF_JOBS_PER_WORKER:
+                        render_pdf_jobs(pool, pending_jobs)
+                        pending_jobs = []
+                elif to_pdf:
+                    save_as_pdf(patient_number, patient, samples_data, parameters, output_dir)
+
+                if to_csv:
+                    save_as_csv(patient_number, patient, samples_data, parameters, output_dir)
+
+                if not to_pdf and not to_csv:
+                    for year, measurements, within_range, collection_date, lab_number in samples_data:
+                        report = generate_report(parameters, measurements, within_range, silent)
+                        print(f"Patient: {full_name}\nNHI: {nhi}\nAddress: {address}\nSex: {sex}\nAge: {age} years\nDate of birth: {dob}\nLab: {lab}")
+                        print("\nBLOOD COUNT\n")
+                        print(f"Date: {collection_date}\nLab Numbers: {lab_number}\n")
+                        print(report)
+
+        if pending_jobs:
+            render_pdf_jobs(pool, pending_jobs)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate blood parameter reports.")
@@ -221,7 +221,11 @@ if __name__ == "__main__":
     parser.add_argument("--to-pdf", action="store_true", help="Save the reports as PDF files")
     parser.add_argument("--to-csv", action="store_true", help="Save the reports as CSV files")
     parser.add_argument("--output-dir", type=str, default=".", help="Directory to save the PDF/CSV files")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible patients and measurements")
+    parser.add_argument("--identity-pool", type=str, help="CSV identity pool created by identity.py to draw patients from")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes used to render PDF reports")
+    parser.add_argument("--patients-per-batch", type=int, default=10000, help="Number of patients whose samples are generated in one vectorized batch")
 
     args = parser.parse_args()
 
-    main(args.patients, args.samples, args.start_year, args.end_year, args.percentage_min, args.percentage_max, args.silent, args.to_pdf, args.to_csv, args.output_dir)
+    main(args.patients, args.samples, args.start_year, args.end_year, args.percentage_min, args.percentage_max, args.silent, args.to_pdf, args.to_csv, args.output_dir, args.seed, args.identity_pool, args.workers, args.patients_per_batch)
@@ -1,23 +1,57 @@
 import os
 import base64
 import glob
-from elasticsearch import Elasticsearch, helpers, NotFoundError
+import hashlib
+import io
+import re
+from elasticsearch import Elasticsearch, NotFoundError
 from dotenv import load_dotenv
 import argparse
 import json
-import time
+import random
+from identity import stream_identities
+from concurrent.futures import ProcessPoolExecutor
+from bulk_ingest import adaptive_bulk
+from bulk_load import bulk_load_settings, restore_settings
+from contextlib import nullcontext
+from blood_samples import BLOOD_PARAMETERS, LAB_LOCATIONS, iter_sample_batches
+
+try:
+    from pypdf import PdfReader
+except ImportError:
+    PdfReader = None
 
 # Load environment variables
 load_dotenv()
 
 # Elasticsearch connection details
 CLOUD_ID = os.getenv('CLOUD_ID')
+ELASTIC_URL = os.getenv('ELASTIC_URL')
 API_KEY = os.getenv('API_KEY')
 INDEX_NAME = os.getenv('INDEX_NAME')
 PIPELINE_NAME = os.getenv('PIPELINE_NAME')
+DIRECT_PIPELINE_NAME = f"{PIPELINE_NAME}-direct"
+
+# Local record of reports already indexed, kept in the uploaded folder by default
+MANIFEST_FILE_NAME = ".ingest-manifest.jsonl"
+
+# Statuses on which the client resends a request, bulk requests are retried per document by bulk_ingest instead
+RETRY_ON_STATUS = (429, 502, 503, 504)
 
 # Connect to Elasticsearch
-es = Elasticsearch(cloud_id=CLOUD_ID, api_key=API_KEY)
+def connect_to_elasticsearch(http_compress=False):
+    # ELASTIC_URL is used when CLOUD_ID is empty, e.g. for a self-managed cluster or the benchmark stand-in
+    connection = {"cloud_id": CLOUD_ID} if CLOUD_ID else {"hosts": ELASTIC_URL}
+    return Elasticsearch(
+        **connection,
+        api_key=API_KEY,
+        http_compress=http_compress,
+        max_retries=3,
+        retry_on_timeout=True,
+        retry_on_status=RETRY_ON_STATUS
+    )
+
+es = None  # Global variable for Elasticsearch connection
 
 def create_pipeline():
     pipeline_body = {
@@ -84,7 +118,38 @@ def create_pipeline():
         print(f"Error creating pipeline: {e}")
         exit(1)
 
-def create_index():
+def create_direct_pipeline():
+    # Documents arrive already structured, so the cluster only has to run ELSER
+    pipeline_body = {
+        "description": "ELSER embedding for pre-structured blood reports",
+        "processors": [
+            {
+                "inference": {
+                    "model_id": ".elser_model_2",
+                    "input_output": [
+                     {
+                            "input_field": "clinical_data",
+                            "output_field": "text_embedding"
+                      }
+                     ]
+                 }
+            },
+            {
+                "remove": {
+                    "field": ["clinical_data"]
+                }
+            }
+        ]
+    }
+
+    try:
+        es.ingest.put_pipeline(id=DIRECT_PIPELINE_NAME, body=pipeline_body)
+        print(f"Pipeline '{DIRECT_PIPELINE_NAME}' created successfully")
+    except Exception as e:
+        print(f"Error creating pipeline: {e}")
+        exit(1)
+
+def create_index(exclude_embeddings=False):
     index_body = {
         "mappings": {
             "properties": {
@@ -125,6 +190,10 @@ def create_index():
             }
         }
     }
+    if exclude_embeddings:
+        # The ELSER embedding stays searchable but isn't stored in _source. Updates, update_by_query and
+        # reindex rebuild documents from _source, so they drop the embedding; re-ingest through the pipeline instead.
+        index_body["mappings"]["_source"] = {"excludes": ["text_embedding"]}
 
     try:
         es.indices.create(index=INDEX_NAME, body=index_body)
@@ -143,12 +212,12 @@ def delete_index():
         print(f"Error deleting index: {e}")
         exit(1)
 
-def delete_pipeline():
+def delete_pipeline(pipeline_name=PIPELINE_NAME):
     try:
-        es.ingest.delete_pipeline(id=PIPELINE_NAME)
-        print(f"Pipeline '{PIPELINE_NAME}' deleted successfully")
+        es.ingest.delete_pipeline(id=pipeline_name)
+        print(f"Pipeline '{pipeline_name}' deleted successfully")
     except NotFoundError:
-        print(f"Pipeline '{PIPELINE_NAME}' not found")
+        print(f"Pipeline '{pipeline_name}' not found")
     except Exception as e:
         print(f"Error deleting pipeline: {e}")
         exit(1)
@@ -156,9 +225,9 @@ def delete_pipeline():
 def index_exists():
     return es.indices.exists(index=INDEX_NAME)
 
-def pipeline_exists():
+def pipeline_exists(pipeline_name=PIPELINE_NAME):
     try:
-        es.ingest.get_pipeline(id=PIPELINE_NAME)
+        es.ingest.get_pipeline(id=pipeline_name)
         return True
     except NotFoundError:
         return False
@@ -166,83 +235,288 @@ def pipeline_exists():
         print(f"Error checking pipeline: {e}")
         exit(1)
 
-def process_pdf(file_path):
-    with open(file_path, 'rb') as file:
-        pdf_content = file.read()
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+def process_pdf(file_path, pdf_content=None):
+    if pdf_content is None:
+        with open(file_path, 'rb') as file:
+            pdf_content = file.read()
     pdf_base64 = base64.b64encode(pdf_content).decode('utf-8')
 
+    # The content hash is the document ID, so re-uploading a report overwrites it instead of duplicating it
     return {
         "_index": INDEX_NAME,
+        "_id": content_hash(pdf_content),
         "pipeline": PIPELINE_NAME,
         "data": pdf_base64,
         "file_name": os.path.basename(file_path)
     }
 
-def bulk_with_retry(actions, max_retries=3, initial_backoff=5):
-    for attempt in range(max_retries):
-        try:
-            success, failed = helpers.bulk(es, actions, stats_only=False, request_timeout=300)
-            return success, failed
-        except helpers.BulkIndexError as e:
-            print(f"Bulk index error on attempt {attempt + 1}: {e}")
-            if attempt == max_retries - 1:
-                raise
-        except Exception as e:
-            print(f"Unexpected error on attempt {attempt + 1}: {e}")
-            if attempt == max_retries - 1:
-                raise
-        time.sleep(initial_backoff * (2 ** attempt))
-
-def bulk_ingest_pdfs(folder_path, batch_size=10):
-    pdf_files = glob.glob(os.path.join(folder_path, "*.pdf"))
+def build_clinical_data(document):
+    # Same text the PDF pipeline's script processor builds from the grok fields
+    parts = [f"Patient Name: {document['patient_name']}", f"NHI: {document['nhi']}"]
+    for param in BLOOD_PARAMETERS:
+        parts.append(f"{param.name}: {document[param.field]:.2f}")
+    return ", ".join(parts)
+
+def build_report_document(patient, sample):
+    full_name, address, nhi, sex, age, dob, lab = patient
+    year, measurements, within_range, collection_date, lab_number = sample
+    document = {
+        "patient_name": full_name,
+        "nhi": nhi,
+        "address": address,
+        "sex": sex,
+        "age": age,
+        "dob": dob,
+        "lab": lab,
+        "test_date": collection_date,
+        "lab_numbers": lab_number
+    }
+    for param in BLOOD_PARAMETERS:
+        document[param.field] = round(measurements[param.name], 2)
+        document[f"{param.field}_range"] = f"{param.lower_bound} - {param.upper_bound}"
+    document["clinical_data"] = build_clinical_data(document)
+    return document
+
+def generate_direct_actions(patients, samples, start_year, end_year, percentage_min, percentage_max, seed=None, identity_pool=None):
+    rng = random.Random(seed)
+    # Identities are generated a chunk at a time alongside the sample batches, so memory doesn't grow with --direct
+    identities = stream_identities(seed=seed, pool_path=identity_pool)
+    for batch in iter_sample_batches(BLOOD_PARAMETERS, patients, start_year, end_year, samples, percentage_min, percentage_max, seed):
+        for patient_index in range(batch.num_patients):
+            full_name, address, sex, age, dob, nhi = next(identities)
+            patient = (full_name, address, nhi, sex, age, dob, rng.choice(LAB_LOCATIONS))
+            for sample in batch.patient_samples(patient_index):
+                yield {
+                    "_index": INDEX_NAME,
+                    "pipeline": DIRECT_PIPELINE_NAME,
+                    "_source": build_report_document(patient, sample)
+                }
+
+def bulk_ingest_direct(patients, samples, start_year, end_year, percentage_min, percentage_max, seed=None, identity_pool=None, **bulk_options):
+    actions = generate_direct_actions(patients, samples, start_year, end_year, percentage_min, percentage_max, seed, identity_pool)
+    parallel_ingest(actions, **bulk_options)
+
+def report_failure(action, error_type, reason):
+    # --direct documents have no ID or file, their lab number (or the patient's NHI) identifies them instead
+    source = action.get("_source", {})
+    name = action.get("file_name") or source.get("file_name") or action.get("_id") or source.get("lab_numbers") or source.get("nhi", "")
+    print(f"Failed to index document {name}: {error_type} {reason}")
+
+def parallel_ingest(actions, threads=4, max_threads=None, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024, max_retries=5, progress_every=1000, on_success=None):
+    # Up to `threads` bulk requests are in flight at once. Only rejected documents are resent, and batch
+    # size and concurrency shrink on rejections or slow responses and grow back while the cluster keeps up.
+    stats = adaptive_bulk(
+        es,
+        actions,
+        chunk_size=chunk_size,
+        max_chunk_bytes=max_chunk_bytes,
+        concurrency=threads,
+        max_concurrency=max_threads,
+        max_retries=max_retries,
+        progress_every=progress_every,
+        on_success=on_success,
+        on_failure=report_failure
+    )
+    stats.print_summary()
+    return stats
+
+def load_manifest(manifest_path):
+    indexed_hashes = set()
+    if not os.path.exists(manifest_path):
+        return indexed_hashes
+    with open(manifest_path, 'r') as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write can leave a truncated last line
+                continue
+            if entry.get("index") == INDEX_NAME:
+                indexed_hashes.add(entry["sha256"])
+    return indexed_hashes
+
+def pending_pdf_actions(pdf_files, indexed_hashes, pending_files, stats):
+    for pdf_file in pdf_files:
+        with open(pdf_file, 'rb') as file:
+            pdf_content = file.read()
+        pdf_hash = content_hash(pdf_content)
+        if pdf_hash in indexed_hashes or pdf_hash in pending_files:
+            stats["skipped"] += 1
+            continue
+        pending_files[pdf_hash] = os.path.basename(pdf_file)
+        yield process_pdf(pdf_file, pdf_content)
+
+# Client-side equivalent of the grok pattern in create_pipeline(), tolerant of how text extractors break lines
+REPORT_HEADER_PATTERN = re.compile(
+    r"Patient:\s*(?P<patient_name>.+?)\s*NHI:\s*(?P<nhi>\S+)\s*"
+    r"Address:\s*(?P<address>.+?)\s*Sex:\s*(?P<sex>\w+)\s*"
+    r"Age:\s*(?P<age>\d+) years\s*Date of birth:\s*(?P<dob>\S+)\s*"
+    r"Lab:\s*(?P<lab>.+?)\s*BLOOD COUNT\s*"
+    r"Date:\s*(?P<test_date>\S+)\s*Lab Numbers:\s*(?P<lab_numbers>\S+)",
+    re.DOTALL
+)
+PARAMETER_PATTERNS = {
+    param.field: re.compile(re.escape(param.name) + r"\s+(?P<value>-?[\d.]+)\s+\S+\s+(?P<range>[\d.]+ - [\d.]+)")
+    for param in BLOOD_PARAMETERS
+}
+
+skip_hashes = set()  # Hashes already in the manifest, set in each extraction worker
+
+def init_extract_worker(indexed_hashes):
+    global skip_hashes
+    skip_hashes = indexed_hashes
+
+def parse_report_text(text):
+    header = REPORT_HEADER_PATTERN.search(text)
+    if not header:
+        raise ValueError("patient details not found")
+    document = header.groupdict()
+    document["age"] = int(document["age"])
+    for field, pattern in PARAMETER_PATTERNS.items():
+        match = pattern.search(text, header.end())
+        if not match:
+            raise ValueError(f"{field} measurement not found")
+        document[field] = float(match.group("value"))
+        document[f"{field}_range"] = match.group("range")
+    document["clinical_data"] = build_clinical_data(document)
+    return document
+
+def extract_pdf_document(file_path):
+    try:
+        with open(file_path, 'rb') as file:
+            pdf_content = file.read()
+    except OSError as e:
+        return file_path, None, None, str(e)
+
+    pdf_hash = content_hash(pdf_content)
+    if pdf_hash in skip_hashes:
+        return file_path, pdf_hash, None, None
+
+    try:
+        text = "\n".join(page.extract_text() for page in PdfReader(io.BytesIO(pdf_content)).pages)
+        document = parse_report_text(text)
+    except Exception as e:
+        return file_path, pdf_hash, None, f"{type(e).__name__}: {e}"
+    document["file_name"] = os.path.basename(file_path)
+    return file_path, pdf_hash, document, None
+
+def extracted_pdf_actions(executor, pdf_files, indexed_hashes, pending_files, stats, window=1000):
+    # Files are submitted in windows so parsed documents don't pile up ahead of the bulk threads
+    for start in range(0, len(pdf_files), window):
+        results = executor.map(extract_pdf_document, pdf_files[start:start + window], chunksize=16)
+        for file_path, pdf_hash, document, error in results:
+            if pdf_hash in indexed_hashes or pdf_hash in pending_files:
+                stats["skipped"] += 1
+                continue
+            if error:
+                stats["parse_failed"] += 1
+                print(f"Failed to parse {file_path}: {error}")
+                continue
+            pending_files[pdf_hash] = document["file_name"]
+            yield {
+                "_index": INDEX_NAME,
+                "_id": pdf_hash,
+                "pipeline": DIRECT_PIPELINE_NAME,
+                "_source": document
+            }
+
+def bulk_ingest_pdfs(folder_path, manifest_path=None, reindex=False, local_extract=False, extract_workers=None, **bulk_options):
+    pdf_files = sorted(glob.glob(os.path.join(folder_path, "*.pdf")))
     
     if not pdf_files:
         print(f"No PDF files found in {folder_path}")
         return
 
-    total_success = 0
-    total_failed = 0
-
-    for i in range(0, len(pdf_files), batch_size):
-        batch = pdf_files[i:i+batch_size]
-        
-        print(f"Processing batch {i//batch_size + 1} of {len(pdf_files)//batch_size + 1}")
-        
-        actions = (process_pdf(pdf_file) for pdf_file in batch)
-        
-        try:
-            success, failed = bulk_with_retry(actions)
-            total_success += success
-            total_failed += len(failed) if failed else 0
-            print(f"Batch {i//batch_size + 1} complete: {success} succeeded, {len(failed) if failed else 0} failed")
-        except Exception as e:
-            print(f"Failed to process batch {i//batch_size + 1}: {e}")
-            total_failed += len(batch)
-
-    print(f"Ingestion complete. Total succeeded: {total_success}, Total failed: {total_failed}")
+    print(f"Found {len(pdf_files)} PDF files in {folder_path}")
+
+    manifest_path = manifest_path or os.path.join(folder_path, MANIFEST_FILE_NAME)
+    indexed_hashes = set() if reindex else load_manifest(manifest_path)
+    if indexed_hashes:
+        print(f"Manifest {manifest_path} lists {len(indexed_hashes)} reports already indexed into '{INDEX_NAME}'")
+
+    pending_files = {}
+    stats = {"skipped": 0, "parse_failed": 0}
+
+    with open(manifest_path, 'a') as manifest:
+        # Each report is recorded as soon as Elasticsearch acknowledges it, so an interrupted run resumes where it stopped
+        def record_indexed(item):
+            file_name = pending_files.pop(item["_id"], None)
+            manifest.write(json.dumps({"index": INDEX_NAME, "sha256": item["_id"], "file_name": file_name}) + "\n")
+            manifest.flush()
+
+        if local_extract:
+            # Reports are parsed across a process pool and only the ELSER inference runs on the cluster
+            with ProcessPoolExecutor(extract_workers, initializer=init_extract_worker, initargs=(indexed_hashes,)) as executor:
+                actions = extracted_pdf_actions(executor, pdf_files, indexed_hashes, pending_files, stats)
+                parallel_ingest(actions, on_success=record_indexed, **bulk_options)
+        else:
+            # Files are read, hashed and encoded lazily, as the bulk threads need them
+            actions = pending_pdf_actions(pdf_files, indexed_hashes, pending_files, stats)
+            parallel_ingest(actions, on_success=record_indexed, **bulk_options)
+
+    print(f"Skipped {stats['skipped']} files already indexed or duplicated (use --reindex to upload them again)")
+    if local_extract:
+        print(f"Failed to parse {stats['parse_failed']} files")
 
 def main(args):
+    global es
+    es = connect_to_elasticsearch(args.compress)
+    bulk_options = {
+        "threads": args.threads,
+        "max_threads": args.max_threads,
+        "chunk_size": args.chunk_size,
+        "max_chunk_bytes": args.max_chunk_bytes,
+        "max_retries": args.max_retries
+    }
+
+    # refresh_interval -1 and zero replicas while loading; the original settings are restored afterwards, or on the next run after a crash
+    load_settings = bulk_load_settings(es, INDEX_NAME, args.translog_tuning, args.forcemerge) if args.bulk_load else nullcontext()
+
     if args.create_pipeline:
         create_pipeline()
+    elif args.create_direct_pipeline:
+        create_direct_pipeline()
     elif args.create_index:
         if not index_exists():
-            create_index()
+            create_index(args.exclude_embeddings_from_source)
         else:
             print(f"Index '{INDEX_NAME}' already exists")
     elif args.delete_index:
         delete_index()
     elif args.delete_pipeline:
         delete_pipeline()
+    elif args.delete_direct_pipeline:
+        delete_pipeline(DIRECT_PIPELINE_NAME)
     elif args.folder:
-        if not pipeline_exists():
-            print(f"Pipeline '{PIPELINE_NAME}' does not exist. Please create it first using --create-pipeline")
+        if args.local_extract and PdfReader is None:
+            print("--local-extract requires pypdf. Please install it using: pip install pypdf")
+            exit(1)
+        folder_pipeline, create_flag = (DIRECT_PIPELINE_NAME, "--create-direct-pipeline") if args.local_extract else (PIPELINE_NAME, "--create-pipeline")
+        if not pipeline_exists(folder_pipeline):
+            print(f"Pipeline '{folder_pipeline}' does not exist. Please create it first using {create_flag}")
+            exit(1)
+        if not index_exists():
+            print(f"Index '{INDEX_NAME}' does not exist. Please create it first using --create-index")
+            exit(1)
+        with load_settings:
+            bulk_ingest_pdfs(args.folder, args.manifest, args.reindex, args.local_extract, args.extract_workers, **bulk_options)
+    elif args.direct:
+        if not pipeline_exists(DIRECT_PIPELINE_NAME):
+            print(f"Pipeline '{DIRECT_PIPELINE_NAME}' does not exist. Please create it first using --create-direct-pipeline")
             exit(1)
         if not index_exists():
             print(f"Index '{INDEX_NAME}' does not exist. Please create it first using --create-index")
             exit(1)
-        bulk_ingest_pdfs(args.folder)
+        with load_settings:
+            bulk_ingest_direct(args.direct, args.samples, args.start_year, args.end_year, args.percentage_min, args.percentage_max, args.seed, args.identity_pool, **bulk_options)
+    elif args.restore_settings:
+        if not restore_settings(es, INDEX_NAME):
+            print(f"No saved settings to restore for '{INDEX_NAME}'")
     else:
-        print("Please specify either --create-pipeline, --create-index, --delete-index, --delete-pipeline, or --folder")
+        print("Please specify either --create-pipeline, --create-direct-pipeline, --create-index, --delete-index, --delete-pipeline, --delete-direct-pipeline, --folder, --direct, or --restore-settings")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Ingest PDFs into Elasticsearch")
@@ -252,6 +526,31 @@ if __name__ == "__main__":
     group.add_argument("--delete-index", action="store_true", help="Delete the Elasticsearch index")
     group.add_argument("--delete-pipeline", action="store_true", help="Delete the ingest pipeline")
     group.add_argument("--folder", help="Path to the folder containing PDF files")
+    group.add_argument("--create-direct-pipeline", action="store_true", help="Create the ELSER-only pipeline used by --direct")
+    group.add_argument("--delete-direct-pipeline", action="store_true", help="Delete the ELSER-only pipeline used by --direct")
+    group.add_argument("--direct", type=int, metavar="PATIENTS", help="Generate reports for this many patients and index them as structured documents, skipping PDF rendering, attachment and grok")
+    group.add_argument("--restore-settings", action="store_true", help="Restore index settings left behind by an interrupted --bulk-load run")
+    parser.add_argument("--samples", type=int, default=5, help="Number of samples per patient and year for --direct")
+    parser.add_argument("--start-year", type=int, default=2020, help="Start year for --direct reports")
+    parser.add_argument("--end-year", type=int, default=2022, help="End year for --direct reports")
+    parser.add_argument("--percentage-min", type=float, default=0, help="Minimum percentage to extend the range for --direct")
+    parser.add_argument("--percentage-max", type=float, default=10, help="Maximum percentage to extend the range for --direct")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible --direct reports")
+    parser.add_argument("--identity-pool", type=str, help="CSV identity pool created by identity.py to draw --direct patients from")
+    parser.add_argument("--manifest", type=str, help=f"Checkpoint manifest of indexed reports for --folder (default: <folder>/{MANIFEST_FILE_NAME})")
+    parser.add_argument("--reindex", action="store_true", help="Upload every report in --folder, ignoring the manifest")
+    parser.add_argument("--local-extract", action="store_true", help="Parse PDFs locally and send structured fields through the ELSER-only pipeline instead of attachment and grok")
+    parser.add_argument("--extract-workers", type=int, help="Number of processes used by --local-extract (default: number of CPUs)")
+    parser.add_argument("--threads", type=int, default=4, help="Initial number of concurrent bulk requests")
+    parser.add_argument("--max-threads", type=int, help="Upper limit for concurrent bulk requests when the cluster keeps up (default: 2x --threads)")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Initial number of documents per bulk request, adjusted to rejections and latency")
+    parser.add_argument("--max-chunk-bytes", type=int, default=10 * 1024 * 1024, help="Maximum payload size in bytes per bulk request")
+    parser.add_argument("--max-retries", type=int, default=5, help="Number of times a rejected document is resent")
+    parser.add_argument("--exclude-embeddings-from-source", action="store_true", help="With --create-index, keep text_embedding out of the stored _source")
+    parser.add_argument("--compress", action="store_true", help="Gzip compress bulk request bodies")
+    parser.add_argument("--bulk-load", action="store_true", help="Disable refresh and replicas while loading and restore them afterwards")
+    parser.add_argument("--translog-tuning", action="store_true", help="With --bulk-load, also use async translog durability and a larger flush threshold")
+    parser.add_argument("--forcemerge", action="store_true", help="With --bulk-load, force merge the index to one segment after loading")
     args = parser.parse_args()
 
     main(args)
@@ -1,30 +1,51 @@
 import os
-import argparse
+import csv
+import json
 import random
-import string
-import requests
-from datetime import datetime
-from elasticsearch import Elasticsearch, helpers, NotFoundError
+import hashlib
+import argparse
+from datetime import date, datetime, timedelta
+from collections import Counter
+from itertools import chain, groupby, islice
+from operator import itemgetter
+from elasticsearch import Elasticsearch, NotFoundError
 from dotenv import load_dotenv
+from identity import generate_identities, load_identity_pool, reference_date, MIN_AGE
+from bulk_ingest import adaptive_bulk, prefetch
+from external_sort import external_sort
+from bulk_load import bulk_load_settings, restore_settings
+from contextlib import nullcontext
+from enrichment import ENRICHMENT_MAPPING
 
 # Load environment variables
 load_dotenv()
 
 # Elasticsearch connection details
 CLOUD_ID = os.getenv('CLOUD_ID')
+ELASTIC_URL = os.getenv('ELASTIC_URL')
 API_KEY = os.getenv('API_KEY')
 INDEX_NAME = "notes-" + os.getenv('INDEX_NAME')
 PIPELINE_NAME = "pipeline-" + INDEX_NAME
 
+# Scale-out mode: every synthetic patient replays a condition's visit timeline shifted by up to
+# MAX_TIMELINE_SHIFT_DAYS, with each visit moved by up to VISIT_JITTER_DAYS and a reworded note
+MAX_TIMELINE_SHIFT_DAYS = 3 * 365
+VISIT_JITTER_DAYS = 3
+MAX_AGE_JITTER = 10
+NOTE_OPENINGS = ["", "", "Seen in clinic. ", "Telehealth consult. ", "Walk-in appointment. ", "Reviewed with practice nurse present. "]
+NOTE_CLOSINGS = ["", "", " Patient understands the plan.", " Safety-netting advice given.", " Advised to return if symptoms worsen.", " Printed information provided.", " Follow-up booked at reception."]
+
 def debug_print(message, debug_mode):
     if debug_mode:
         print(f"DEBUG: {message}")
 
 # Connect to Elasticsearch
-def connect_to_elasticsearch(debug_mode):
+def connect_to_elasticsearch(debug_mode, http_compress=False):
     debug_print("Connecting to Elasticsearch...", debug_mode)
     try:
-        es = Elasticsearch(cloud_id=CLOUD_ID, api_key=API_KEY)
+        # ELASTIC_URL is used when CLOUD_ID is empty, e.g. for a self-managed cluster or the benchmark stand-in
+        connection = {"cloud_id": CLOUD_ID} if CLOUD_ID else {"hosts": ELASTIC_URL}
+        es = Elasticsearch(**connection, api_key=API_KEY, http_compress=http_compress)
         debug_print("Successfully connected to Elasticsearch", debug_mode)
         return es
     except Exception as e:
@@ -33,25 +54,6 @@ def connect_to_elasticsearch(debug_mode):
 
 es = None  # Global variable for Elasticsearch connection
 
-def get_random_user(debug_mode):
-    debug_print("Fetching random user data...", debug_mode)
-    response = requests.get('https://randomuser.me/api/?nat=nz')
-    if response.status_code == 200:
-        user_data = response.json()['results'][0]
-        full_name = f"{user_data['name']['first']} {user_data['name']['last']}"
-        dob = user_data['dob']['date'].split('T')[0]
-        address = f"{user_data['location']['street']['number']} {user_data['location']['street']['name']}, {user_data['location']['city']}, {user_data['location']['postcode']}, {user_data['location']['state']}, New Zealand"
-        debug_print(f"Random user data fetched: {full_name}", debug_mode)
-        return full_name, dob, address
-    else:
-        debug_print("Failed to fetch random user data, using default", debug_mode)
-        return "John Doe", "1980-01-01", "123 Fake Street, Faketown, 0000, FakeState, New Zealand"
-
-def generate_nhi(debug_mode):
-    nhi = ''.join(random.choices(string.ascii_uppercase + string.digits, k=7))
-    debug_print(f"Generated NHI: {nhi}", debug_mode)
-    return nhi
-
 def create_pipeline(debug_mode):
     debug_print("Creating pipeline...", debug_mode)
     pipeline_body = {
@@ -98,7 +100,7 @@ def create_pipeline(debug_mode):
         debug_print(f"Error creating pipeline: {e}", debug_mode)
         raise
 
-def create_index(debug_mode):
+def create_index(debug_mode, exclude_embeddings=False):
     debug_print("Creating index...", debug_mode)
     index_body = {
         "mappings": {
@@ -113,10 +115,16 @@ def create_index(debug_mode):
                 "age": {"type": "integer"},
                 "note_date": {"type": "date", "format": "yyyy-MM-dd"},
                 "clinical_note": {"type": "text"},
-                "text_embedding": {"type": "sparse_vector"}
+                "content_hash": {"type": "keyword"},
+                "text_embedding": {"type": "sparse_vector"},
+                **ENRICHMENT_MAPPING
             }
         }
     }
+    if exclude_embeddings:
+        # The ELSER embedding stays searchable but isn't stored in _source. Updates, update_by_query and
+        # reindex rebuild documents from _source, so they drop the embedding; re-ingest through the pipeline instead.
+        index_body["mappings"]["_source"] = {"excludes": ["text_embedding"]}
 
     try:
         es.indices.create(index=INDEX_NAME, body=index_body)
@@ -166,7 +174,6 @@ def pipeline_exists(debug_mode):
 
 def read_csv_data(csv_file, debug_mode):
     debug_print(f"Reading CSV file: {csv_file}", debug_mode)
-    import csv
     data = {}
     try:
         with open(csv_file, mode='r', newline='') as file:
@@ -191,84 +198,244 @@ def read_csv_data(csv_file, debug_mode):
         debug_print(f"Error reading CSV file: {e}", debug_mode)
         raise
 
-def generate_and_upload_data(input_csv, simulate, debug_mode):
-    debug_print("Generating and uploading data...", debug_mode)
-    data = read_csv_data(input_csv, debug_mode)
+def stream_csv_data(csv_file, debug_mode, run_size=100000, temp_dir=None):
+    # Bounded-memory alternative to read_csv_data() for large exports: rows are sorted by condition and
+    # date in runs of run_size, spilled to disk and merged, then grouped one condition at a time.
+    # Yields (condition, patient_data) pairs whose 'Visits' is an iterator over the merged rows.
+    debug_print(f"Streaming CSV file: {csv_file}", debug_mode)
 
-    total_documents = 0
-    failed_documents = 0
-    used_notes = {}
+    def rows():
+        with open(csv_file, mode='r', newline='') as file:
+            reader = csv.DictReader(file)
+            for row in reader:
+                try:
+                    note_date = date.fromisoformat(row['Date']).isoformat()
+                except ValueError:
+                    raise ValueError(f"Invalid date '{row['Date']}' on line {reader.line_num} of {csv_file}")
+                yield [row['Condition'], note_date, row['Gender'], row['Age'], row['Note']]
 
-    for condition, patient_data in data.items():
-        patient_name, patient_dob, patient_address = get_random_user(debug_mode)
-        gp_name, _, _ = get_random_user(debug_mode)
-        nhi = generate_nhi(debug_mode)
+    def report_run(runs, size):
+        debug_print(f"Sorted run {runs} ({size} rows) written to disk", debug_mode)
 
-        patient_key = f"{patient_name}_{nhi}"
-        used_notes[patient_key] = set()
+    sorted_rows = external_sort(rows(), key=itemgetter(0, 1), run_size=run_size, temp_dir=temp_dir, on_run=report_run)
+    for condition, group in groupby(sorted_rows, key=itemgetter(0)):
+        first = next(group)
+        visits = chain([(first[1], first[4])], ((row[1], row[4]) for row in group))
+        yield condition, {'Gender': first[2], 'Age': first[3], 'Visits': visits}
 
-        actions = []
+def note_id(condition, note_date, ordinal, synthetic_patient=None):
+    # Stable across runs: a note is identified by its condition, date and position among that day's notes.
+    # Scaled notes also carry their synthetic patient, so they never overwrite the real notes or another seed's.
+    key = f"{condition}\x1f{note_date}\x1f{ordinal}"
+    if synthetic_patient is not None:
+        key = f"{synthetic_patient}\x1f{key}"
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def source_hash(source):
+    return hashlib.sha256(json.dumps(source, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def build_note_action(patient, gp, condition, gender, age, note_date, clinical_note, ordinal=0, synthetic_patient=None):
+    source = {
+        "patient_name": patient.full_name,
+        "dob": patient.dob,
+        "patient_address": patient.address,
+        "nhi": patient.nhi,
+        "gp_name": f"Dr. {gp.full_name}",
+        "condition": condition,
+        "gender": gender,
+        "age": age,
+        "note_date": note_date,
+        "clinical_note": clinical_note
+    }
+    # Hash of everything the pipeline embeds, so an unchanged note can skip ELSER on re-ingest
+    source["content_hash"] = source_hash(source)
+    return {
+        "_index": INDEX_NAME,
+        "_id": note_id(condition, note_date, ordinal, synthetic_patient),
+        "pipeline": PIPELINE_NAME,
+        "_source": source
+    }
+
+def keyed_rng(seed, *key):
+    # Seeded by what is being generated rather than by its position in the input, so adding or
+    # reordering conditions leaves every other condition's patient, GP and notes as they were
+    if seed is None:
+        return random.Random()
+    return random.Random(":".join(str(part) for part in (seed, *key)))
+
+def patient_and_gp(rng, seed, pool=None):
+    if pool:
+        return rng.choices(pool, k=2)
+    return generate_identities(2, rng=rng, today=reference_date(seed))
+
+def generate_note_actions(conditions, seed=None, pool=None, debug_mode=False):
+    for condition, patient_data in conditions:
+        patient, gp = patient_and_gp(keyed_rng(seed, condition), seed, pool)
+        ordinals = Counter()
+
+        visits = 0
         for visit_date, clinical_note in patient_data['Visits']:
-            # Create a unique key for this note
-            note_key = f"{condition}_{clinical_note}"
-            
-            # If this note has been used for this patient, modify it
-            count = 1
-            while note_key in used_notes[patient_key]:
-                clinical_note = f"{clinical_note} (Variation {count})"
-                note_key = f"{condition}_{clinical_note}"
-                count += 1
-            
-            used_notes[patient_key].add(note_key)
-
-            action = {
-                "_index": INDEX_NAME,
-                "_source": {
-                    "patient_name": patient_name,
-                    "dob": patient_dob,
-                    "patient_address": patient_address,
-                    "nhi": nhi,
-                    "gp_name": f"Dr. {gp_name}",
-                    "condition": condition,
-                    "gender": patient_data['Gender'],
-                    "age": int(patient_data['Age']),
-                    "note_date": visit_date,
-                    "clinical_note": clinical_note
-                }
-            }
-            actions.append(action)
+            visits += 1
+            ordinal = ordinals[visit_date]
+            ordinals[visit_date] += 1
+            yield build_note_action(patient, gp, condition, patient_data['Gender'], int(patient_data['Age']), visit_date, clinical_note, ordinal)
+
+        debug_print(f"Generated {visits} actions for condition: {condition}", debug_mode)
+
+def vary_note(clinical_note, rng):
+    return f"{rng.choice(NOTE_OPENINGS)}{clinical_note}{rng.choice(NOTE_CLOSINGS)}"
+
+def generate_scaled_note_actions(data, target_docs, seed=None, pool=None, debug_mode=False):
+    # Lazily fans the conditions out over as many synthetic patients as it takes to reach target_docs,
+    # so memory stays flat whatever the target
+    timelines = [
+        (condition, patient_data['Gender'], int(patient_data['Age']), [(datetime.strptime(visit_date, '%Y-%m-%d').date(), note) for visit_date, note in patient_data['Visits']])
+        for condition, patient_data in data.items()
+    ]
+
+    produced = 0
+    patients = 0
+    while produced < target_docs:
+        condition, gender, age, visits = timelines[patients % len(timelines)]
+        # Each synthetic patient is seeded by its condition and copy number, like the unscaled notes
+        copy = patients // len(timelines)
+        rng = keyed_rng(seed, condition, copy)
+        patient, gp = patient_and_gp(rng, seed, pool)
+        patient_age = max(MIN_AGE, age + rng.randint(-MAX_AGE_JITTER, MAX_AGE_JITTER))
+        shift = timedelta(days=rng.randint(-MAX_TIMELINE_SHIFT_DAYS, MAX_TIMELINE_SHIFT_DAYS))
+        previous_date = None
+        for visit_date, clinical_note in visits:
+            if produced >= target_docs:
+                break
+            note_date = visit_date + shift + timedelta(days=rng.randint(0, VISIT_JITTER_DAYS))
+            # Jitter must not reorder the visits of one timeline
+            if previous_date and note_date <= previous_date:
+                note_date = previous_date + timedelta(days=1)
+            previous_date = note_date
+            # A timeline's dates are strictly increasing, so its notes never share a day
+            yield build_note_action(patient, gp, condition, gender, patient_age, note_date.isoformat(), vary_note(clinical_note, rng),
+                                    synthetic_patient=f"{seed}:{copy}")
+            produced += 1
+        patients += 1
+        if patients % 10000 == 0:
+            debug_print(f"Generated notes for {patients} synthetic patients", debug_mode)
 
-        debug_print(f"Generated {len(actions)} actions for condition: {condition}", debug_mode)
+def load_hash_cache(cache_path):
+    hashes = {}
+    if not os.path.exists(cache_path):
+        return hashes
+    with open(cache_path, 'r') as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A run killed mid-write can leave a truncated last line
+                continue
+            if entry.get("index") == INDEX_NAME:
+                hashes[entry["_id"]] = entry["content_hash"]
+    return hashes
 
-        if simulate:
-            print(f"Simulation mode: Not uploading to Elasticsearch. Sample action: {actions[0]}")
+def indexed_hashes(ids):
+    response = es.mget(index=INDEX_NAME, ids=ids, source=["content_hash"])
+    return {doc["_id"]: doc["_source"].get("content_hash") for doc in response["docs"] if doc.get("found")}
+
+def skip_unchanged_notes(actions, lookup, stats, batch_size=1000):
+    # Looks up stored hashes a batch at a time, so only new or modified notes reach the pipeline
+    actions = iter(actions)
+    while True:
+        batch = list(islice(actions, batch_size))
+        if not batch:
             return
+        stored = lookup([action["_id"] for action in batch])
+        for action in batch:
+            if stored.get(action["_id"]) == action["_source"]["content_hash"]:
+                stats["skipped"] += 1
+                continue
+            yield action
+
+def generate_and_upload_data(input_csv, simulate, debug_mode, seed=None, identity_pool=None, target_docs=None, threads=4, max_threads=None, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024, max_retries=5,
+                             stream_input=False, sort_run_size=100000, temp_dir=None, skip_unchanged=False, hash_cache=None):
+    debug_print("Generating and uploading data...", debug_mode)
+
+    pool = load_identity_pool(identity_pool) if identity_pool else None
+    if identity_pool and not pool:
+        raise ValueError(f"Identity pool '{identity_pool}' is empty")
+
+    if stream_input:
+        conditions = stream_csv_data(input_csv, debug_mode, sort_run_size, temp_dir)
+        actions = generate_note_actions(conditions, seed, pool, debug_mode)
+    elif target_docs:
+        data = read_csv_data(input_csv, debug_mode)
+        debug_print(f"Scaling {len(data)} conditions out to {target_docs} notes", debug_mode)
+        actions = generate_scaled_note_actions(data, target_docs, seed, pool, debug_mode)
+    else:
+        # One patient and one GP per condition, generated locally
+        data = read_csv_data(input_csv, debug_mode)
+        actions = generate_note_actions(data.items(), seed, pool, debug_mode)
+
+    if simulate:
+        print(f"Simulation mode: Not uploading to Elasticsearch. Sample action: {next(actions, None)}")
+        return
+
+    stats = {"skipped": 0}
+    cache = load_hash_cache(hash_cache) if hash_cache else None
+    if skip_unchanged:
+        # A local cache avoids a round trip per batch, the index is the source of truth otherwise
+        actions = skip_unchanged_notes(actions, (lambda ids: cache) if cache is not None else indexed_hashes, stats)
+
+    pending_hashes = {}
+
+    def track_pending(actions):
+        for action in actions:
+            pending_hashes[action["_id"]] = action["_source"]["content_hash"]
+            yield action
+
+    def record_indexed(item):
+        content_hash = pending_hashes.pop(item["_id"], None)
+        cache_file.write(json.dumps({"index": INDEX_NAME, "_id": item["_id"], "content_hash": content_hash}) + "\n")
+        cache_file.flush()
+
+    def report_failure(action, error_type, reason):
+        pending_hashes.pop(action["_id"], None)
+        debug_print(f"Failed to index note dated {action['_source']['note_date']} for condition {action['_source']['condition']}: {error_type} {reason}", debug_mode)
+
+    # Notes for every condition go through one stream: actions are built on a background thread while
+    # up to `threads` bulk requests are in flight, and only rejected notes are resent
+    cache_file = open(hash_cache, 'a') if hash_cache else None
+    try:
+        bulk_stats = adaptive_bulk(
+            es,
+            prefetch(track_pending(actions) if cache_file else actions, buffer_size=chunk_size * 2),
+            chunk_size=chunk_size,
+            max_chunk_bytes=max_chunk_bytes,
+            concurrency=threads,
+            max_concurrency=max_threads,
+            max_retries=max_retries,
+            on_success=record_indexed if cache_file else None,
+            on_failure=report_failure
+        )
+    finally:
+        if cache_file:
+            cache_file.close()
+    for error_type, count in bulk_stats.errors.items():
+        debug_print(f"{error_type}: {count} ({bulk_stats.failures[error_type]} failed permanently)", debug_mode)
 
-        try:
-            success, failed = helpers.bulk(es, actions, pipeline=PIPELINE_NAME, stats_only=True)
-            total_documents += success
-            failed_documents += failed
-            debug_print(f"Uploaded {success} documents for condition: {condition}. Failed: {failed}", debug_mode)
-        except helpers.BulkIndexError as e:
-            debug_print(f"Bulk indexing failed for condition {condition}: {e}", debug_mode)
-            failed_documents += len(actions)
-        except Exception as e:
-            debug_print(f"Unexpected error occurred while uploading condition {condition}: {e}", debug_mode)
-            failed_documents += len(actions)
-
-    print(f"Total documents uploaded: {total_documents}")
-    print(f"Total documents failed: {failed_documents}")
+    bulk_stats.print_summary()
+    print(f"Total documents uploaded: {bulk_stats.succeeded}")
+    print(f"Total documents failed: {bulk_stats.failed}")
+    if skip_unchanged:
+        print(f"Skipped {stats['skipped']} unchanged notes")
 
 def main(args):
     global es
     try:
-        es = connect_to_elasticsearch(args.debug)
+        es = connect_to_elasticsearch(args.debug, args.compress)
         
         if args.create_pipeline:
             create_pipeline(args.debug)
         elif args.create_index:
             if not index_exists(args.debug):
-                create_index(args.debug)
+                create_index(args.debug, args.exclude_embeddings_from_source)
             else:
                 debug_print(f"Index '{INDEX_NAME}' already exists", args.debug)
         elif args.delete_index:
@@ -282,9 +449,17 @@ def main(args):
             if not index_exists(args.debug):
                 debug_print(f"Index '{INDEX_NAME}' does not exist. Please create it first using --create-index", args.debug)
                 exit(1)
-            generate_and_upload_data(args.input_csv, args.simulate, args.debug)
+            # refresh_interval -1 and zero replicas while loading; the original settings are restored afterwards, or on the next run after a crash
+            load_settings = bulk_load_settings(es, INDEX_NAME, args.translog_tuning, args.forcemerge) if args.bulk_load and not args.simulate else nullcontext()
+            with load_settings:
+                generate_and_upload_data(args.input_csv, args.simulate, args.debug, args.seed, args.identity_pool, args.target_docs,
+                                         args.threads, args.max_threads, args.chunk_size, args.max_chunk_bytes, args.max_retries,
+                                         args.stream_input, args.sort_run_size, args.temp_dir, args.skip_unchanged, args.hash_cache)
+        elif args.restore_settings:
+            if not restore_settings(es, INDEX_NAME):
+                debug_print(f"No saved settings to restore for '{INDEX_NAME}'", args.debug)
         else:
-            debug_print("Please specify either --create-pipeline, --create-index, --delete-index, --delete-pipeline, or --input-csv", args.debug)
+            debug_print("Please specify either --create-pipeline, --create-index, --delete-index, --delete-pipeline, --input-csv, or --restore-settings", args.debug)
     except Exception as e:
         print(f"An error occurred: {str(e)}")
         if args.debug:
@@ -299,9 +474,34 @@ if __name__ == "__main__":
     group.add_argument("--delete-index", action="store_true", help="Delete the Elasticsearch index")
     group.add_argument("--delete-pipeline", action="store_true", help="Delete the ingest pipeline")
     group.add_argument("--input-csv", type=str, help="Input CSV file containing symptom data")
+    group.add_argument("--restore-settings", action="store_true", help="Restore index settings left behind by an interrupted --bulk-load run")
     parser.add_argument("--simulate", action="store_true", help="Simulate data generation without uploading to Elasticsearch")
     parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible patient and GP identities")
+    parser.add_argument("--identity-pool", type=str, help="CSV identity pool created by identity.py to draw patients and GPs from")
+    parser.add_argument("--target-docs", type=int, help="Scale the input out to this many notes by replaying each condition's visits for many synthetic patients")
+    parser.add_argument("--stream-input", action="store_true", help="Read --input-csv in chunks and order visits with an on-disk merge sort, for exports too large for memory")
+    parser.add_argument("--sort-run-size", type=int, default=100000, help="Number of CSV rows sorted in memory per on-disk run for --stream-input")
+    parser.add_argument("--temp-dir", type=str, help="Directory for the sorted runs of --stream-input (default: system temp directory)")
+    parser.add_argument("--skip-unchanged", action="store_true", help="Only send notes that are new or whose content changed since they were indexed")
+    parser.add_argument("--hash-cache", type=str, help="Local file of indexed note hashes; checked by --skip-unchanged instead of the index and updated as notes are indexed")
+    parser.add_argument("--threads", type=int, default=4, help="Initial number of concurrent bulk requests")
+    parser.add_argument("--max-threads", type=int, help="Upper limit for concurrent bulk requests when the cluster keeps up (default: 2x --threads)")
+    parser.add_argument("--chunk-size", type=int, default=500, help="Initial number of notes per bulk request, adjusted to rejections and latency")
+    parser.add_argument("--max-chunk-bytes", type=int, default=10 * 1024 * 1024, help="Maximum payload size in bytes per bulk request")
+    parser.add_argument("--max-retries", type=int, default=5, help="Number of times a rejected note is resent")
+    parser.add_argument("--exclude-embeddings-from-source", action="store_true", help="With --create-index, keep text_embedding out of the stored _source (the enrichment job can't update such an index)")
+    parser.add_argument("--compress", action="store_true", help="Gzip compress bulk request bodies")
+    parser.add_argument("--bulk-load", action="store_true", help="Disable refresh and replicas while loading and restore them afterwards")
+    parser.add_argument("--translog-tuning", action="store_true", help="With --bulk-load, also use async translog durability and a larger flush threshold")
+    parser.add_argument("--forcemerge", action="store_true", help="With --bulk-load, force merge the index to one segment after loading")
 
     args = parser.parse_args()
+    # Scaling replays every condition's timeline over and over, which needs them all in memory
+    if args.stream_input and args.target_docs:
+        parser.error("--target-docs can't be combined with --stream-input")
+    # Patient identities are part of each note's content hash, so without a seed every note looks changed
+    if args.skip_unchanged and args.seed is None:
+        parser.error("--skip-unchanged needs --seed, so each run draws the same patient identities")
 
     main(args)
@@ -0,0 +1,179 @@
+import os
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import Elasticsearch
+from dotenv import load_dotenv
+from bulk_ingest import adaptive_bulk
+from text_analysis import infer_batch
+from enrichment import ENRICHMENT_MAPPING, ENRICHMENT_VERSION
+
+# Load environment variables
+load_dotenv()
+
+# Elasticsearch connection details
+CLOUD_ID = os.getenv('CLOUD_ID')
+ELASTIC_URL = os.getenv('ELASTIC_URL')
+API_KEY = os.getenv('API_KEY')
+INDEX_NAME = "notes-" + os.getenv('INDEX_NAME')
+
+# The same models the app's Text Analysis tab uses
+NER_MODEL = os.getenv('NER_MODEL')
+SENTIMENT_MODEL = os.getenv('SENTIMENT_MODEL')
+ZERO_SHOT_MODEL = os.getenv('ZERO_SHOT_MODEL')
+
+NOTE_CATEGORIES = ["Respiratory", "Cardiovascular", "Neurological", "Gastrointestinal", "Musculoskeletal", "Dermatological", "Mental Health"]
+
+PIT_KEEP_ALIVE = "5m"
+
+def debug_print(message, debug_mode):
+    if debug_mode:
+        print(f"DEBUG: {message}")
+
+def connect_to_elasticsearch(debug_mode):
+    debug_print("Connecting to Elasticsearch...", debug_mode)
+    # ELASTIC_URL is used when CLOUD_ID is empty, e.g. for a self-managed cluster
+    connection = {"cloud_id": CLOUD_ID} if CLOUD_ID else {"hosts": ELASTIC_URL}
+    return Elasticsearch(**connection, api_key=API_KEY)
+
+def pending_notes_query(force=False):
+    # Notes already carrying the current version are skipped, which is what lets an interrupted run resume
+    if force:
+        return {"match_all": {}}
+    return {"bool": {"must_not": {"term": {"enrichment_version": ENRICHMENT_VERSION}}}}
+
+def scan_notes(es, batch_size, force=False, limit=None, debug_mode=False):
+    # Pages through a point in time with search_after on _shard_doc, the cheapest sort for a full pass.
+    # Unlike a scroll, nothing is held between pages beyond the PIT itself.
+    pit_id = es.open_point_in_time(index=INDEX_NAME, keep_alive=PIT_KEEP_ALIVE)["id"]
+    search_after = None
+    returned = 0
+    try:
+        while limit is None or returned < limit:
+            size = batch_size if limit is None else min(batch_size, limit - returned)
+            response = es.search(
+                pit={"id": pit_id, "keep_alive": PIT_KEEP_ALIVE},
+                query=pending_notes_query(force),
+                sort=[{"_shard_doc": "asc"}],
+                search_after=search_after,
+                size=size,
+                source=["clinical_note"],
+                track_total_hits=False
+            )
+            pit_id = response.get("pit_id", pit_id)
+            hits = response["hits"]["hits"]
+            if not hits:
+                break
+            debug_print(f"Fetched {len(hits)} notes", debug_mode)
+            returned += len(hits)
+            yield [(hit["_id"], hit["_source"].get("clinical_note", "")) for hit in hits]
+            search_after = hits[-1]["sort"]
+    finally:
+        es.close_point_in_time(id=pit_id)
+
+def enrichment_fields(entities, sentiment, category):
+    # A model warning (e.g. an input it can't handle) leaves the note unenriched, so the next run retries it
+    if any("warning" in result for result in (entities, sentiment, category)):
+        return None
+    top_class = max(category.get("top_classes", []), key=lambda c: c["class_probability"], default={})
+    return {
+        "entities": [{"entity": e["entity"], "class_name": e["class_name"]} for e in entities.get("entities", [])],
+        "sentiment": sentiment.get("predicted_value"),
+        "sentiment_score": sentiment.get("prediction_probability"),
+        "category": top_class.get("class_name", category.get("predicted_value")),
+        "category_score": top_class.get("class_probability", category.get("prediction_probability")),
+        "enrichment_version": ENRICHMENT_VERSION,
+        "enriched_at": int(time.time() * 1000)
+    }
+
+def enrich_page(es, page, labels, infer_batch_size):
+    ids = [note_id for note_id, _ in page]
+    texts = [text for _, text in page]
+    # Each model has its own deployment, so the three are asked at the same time. The app's
+    # inference cache is bypassed, every note is inferred once.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        entities = executor.submit(infer_batch, es, NER_MODEL, texts, None, infer_batch_size, None)
+        sentiment = executor.submit(infer_batch, es, SENTIMENT_MODEL, texts, None, infer_batch_size, None)
+        category = executor.submit(infer_batch, es, ZERO_SHOT_MODEL, texts, labels, infer_batch_size, None)
+        results = zip(ids, entities.result(), sentiment.result(), category.result())
+    return [(note_id, enrichment_fields(*models)) for note_id, *models in results]
+
+def enriched_note_updates(es, pages, labels, concurrency, infer_batch_size, stats, debug_mode):
+    # Up to `concurrency` pages are inferred at once; results are yielded in page order as partial updates
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = deque()
+        pages = iter(pages)
+        while True:
+            while len(in_flight) < concurrency:
+                page = next(pages, None)
+                if page is None:
+                    break
+                in_flight.append((len(page), executor.submit(enrich_page, es, page, labels, infer_batch_size)))
+            if not in_flight:
+                return
+            page_size, future = in_flight.popleft()
+            try:
+                enriched = future.result()
+            except Exception as e:
+                # The page is left for the next run rather than stopping the whole job
+                stats["failed_inference"] += page_size
+                print(f"Inference failed for a page of {page_size} notes: {e}")
+                continue
+            for note_id, fields in enriched:
+                if fields is None:
+                    stats["warnings"] += 1
+                    debug_print(f"Model warning for note {note_id}, left for the next run", debug_mode)
+                    continue
+                yield {"_op_type": "update", "_index": INDEX_NAME, "_id": note_id, "doc": fields}
+
+def update_mapping(es, debug_mode):
+    # Partial updates rebuild each note from _source, so on an index created with
+    # --exclude-embeddings-from-source they would silently drop the ELSER embedding
+    mapping = es.indices.get_mapping(index=INDEX_NAME)[INDEX_NAME]["mappings"]
+    if "text_embedding" in mapping.get("_source", {}).get("excludes", []):
+        raise RuntimeError(f"'{INDEX_NAME}' excludes text_embedding from _source, updating its notes would drop their embeddings")
+    # Adding fields to an existing mapping is idempotent, so this runs on every start
+    es.indices.put_mapping(index=INDEX_NAME, properties=ENRICHMENT_MAPPING)
+    debug_print(f"Enrichment fields mapped on '{INDEX_NAME}'", debug_mode)
+
+def enrich_notes(es, batch_size=256, infer_batch_size=32, concurrency=2, threads=2, labels=None, force=False, limit=None, debug_mode=False):
+    update_mapping(es, debug_mode)
+    stats = {"failed_inference": 0, "warnings": 0}
+    pages = scan_notes(es, batch_size, force, limit, debug_mode)
+    updates = enriched_note_updates(es, pages, labels or NOTE_CATEGORIES, concurrency, infer_batch_size, stats, debug_mode)
+
+    def report_failure(action, error_type, reason):
+        debug_print(f"Failed to update note {action['_id']}: {error_type} {reason}", debug_mode)
+
+    bulk_stats = adaptive_bulk(es, updates, chunk_size=batch_size, concurrency=threads, on_failure=report_failure)
+    bulk_stats.print_summary()
+    print(f"Total notes enriched: {bulk_stats.succeeded}")
+    print(f"Total updates failed: {bulk_stats.failed}")
+    if stats["failed_inference"] or stats["warnings"]:
+        print(f"Left for the next run: {stats['failed_inference']} notes in failed inference requests, {stats['warnings']} notes with model warnings")
+
+def main(args):
+    try:
+        es = connect_to_elasticsearch(args.debug)
+        enrich_notes(es, args.batch_size, args.infer_batch_size, args.concurrency, args.threads, args.labels, args.force, args.limit, args.debug)
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        if args.debug:
+            import traceback
+            print(traceback.format_exc())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Enrich indexed clinical notes with named entities, sentiment and a zero-shot category")
+    parser.add_argument("--batch-size", type=int, default=256, help="Notes fetched per page and sent per bulk update request")
+    parser.add_argument("--infer-batch-size", type=int, default=32, help="Notes per _infer request")
+    parser.add_argument("--concurrency", type=int, default=2, help="Number of pages inferred at the same time")
+    parser.add_argument("--threads", type=int, default=2, help="Number of concurrent bulk update requests")
+    parser.add_argument("--labels", nargs="+", help=f"Zero-shot categories (default: {', '.join(NOTE_CATEGORIES)})")
+    parser.add_argument("--limit", type=int, help="Stop after this many notes, e.g. to try the models on a sample")
+    parser.add_argument("--force", action="store_true", help="Re-enrich notes that are already enriched with the current version")
+    parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,194 @@
+# fake_elasticsearch.py
+import json
+import gzip
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class BulkMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = []  # (docs, rejected, wire bytes, body bytes, latency)
+            self.first_request = None
+            self.last_response = None
+            self.in_flight = 0
+
+    def record(self, started, docs, rejected, wire_bytes, body_bytes):
+        finished = time.time()
+        with self.lock:
+            self.requests.append((docs, rejected, wire_bytes, body_bytes, finished - started))
+            self.first_request = min(self.first_request or started, started)
+            self.last_response = finished
+
+    def summary(self):
+        with self.lock:
+            requests = list(self.requests)
+            elapsed = (self.last_response - self.first_request) if requests else 0
+        latencies = sorted(request[4] for request in requests)
+        docs = sum(request[0] for request in requests)
+        rejected = sum(request[1] for request in requests)
+
+        def percentile(value):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * value / 100))] if latencies else 0
+
+        return {
+            "bulk_requests": len(requests),
+            "docs_received": docs,
+            "docs_indexed": docs - rejected,
+            "docs_rejected": rejected,
+            "wire_bytes": sum(request[2] for request in requests),
+            "body_bytes": sum(request[3] for request in requests),
+            "elapsed": elapsed,
+            "p50_batch_latency": percentile(50),
+            "p99_batch_latency": percentile(99)
+        }
+
+class FakeElasticsearch:
+    # Minimal stand-in for the endpoints the ingest scripts call. Bulk requests take
+    # `latency` + `per_doc_latency` per document, reject a random `reject_rate` share of
+    # items, and reject items with 429 while more than `capacity` bulk requests are in flight.
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, per_doc_latency=0.0, reject_rate=0.0, capacity=0, seed=None):
+        self.latency = latency
+        self.per_doc_latency = per_doc_latency
+        self.reject_rate = reject_rate
+        self.capacity = capacity
+        self.random = random.Random(seed)
+        self.metrics = BulkMetrics()
+        self.content_hashes = {}  # _id -> content_hash of indexed documents, served back by _mget
+        self.settings = {}  # index -> flat settings changed through _settings
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle_bulk(self, body):
+        lines = [line for line in body.split(b"\n") if line.strip()]
+        with self.metrics.lock:
+            self.metrics.in_flight += 1
+            overloaded = self.capacity and self.metrics.in_flight > self.capacity
+        try:
+            items = []
+            index = 0
+            while index < len(lines):
+                header = json.loads(lines[index])
+                op_type, meta = next(iter(header.items()))
+                index += 1 if op_type == "delete" else 2
+                if overloaded or self.random.random() < self.reject_rate:
+                    items.append({op_type: {"_index": meta.get("_index"), "_id": meta.get("_id"), "status": 429, "error": {"type": "es_rejected_execution_exception", "reason": "rejected execution (queue capacity reached)"}}})
+                else:
+                    items.append({op_type: {"_index": meta.get("_index"), "_id": meta.get("_id") or f"fake-{self.random.getrandbits(64):x}", "result": "created", "status": 201}})
+                    if meta.get("_id") and op_type in ("index", "create"):
+                        self.content_hashes[meta["_id"]] = json.loads(lines[index - 1]).get("content_hash")
+            time.sleep(self.latency + self.per_doc_latency * len(items))
+        finally:
+            with self.metrics.lock:
+                self.metrics.in_flight -= 1
+        rejected = sum(1 for item in items if next(iter(item.values()))["status"] == 429)
+        return {"took": 1, "errors": rejected > 0, "items": items}, len(items), rejected
+
+    def make_handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, status, body=None):
+                payload = json.dumps(body).encode() if body is not None else b""
+                self.send_response(status)
+                self.send_header("X-Elastic-Product", "Elasticsearch")
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(payload)
+
+            def read_body(self):
+                wire = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                body = gzip.decompress(wire) if self.headers.get("Content-Encoding") == "gzip" else wire
+                return wire, body
+
+            def route(self):
+                started = time.time()
+                wire, body = self.read_body()
+                path = self.path.split("?")[0]
+
+                if path == "/_fake/stats":
+                    if self.command == "DELETE":
+                        fake.metrics.reset()
+                    return self.send_json(200, fake.metrics.summary())
+                if path.endswith("/_bulk"):
+                    response, docs, rejected = fake.handle_bulk(body)
+                    fake.metrics.record(started, docs, rejected, len(wire), len(body))
+                    return self.send_json(200, response)
+                if path == "/":
+                    return self.send_json(200, {"name": "fake", "cluster_name": "fake", "version": {"number": "8.14.0"}, "tagline": "You Know, for Search"})
+                if path.startswith("/_ingest/pipeline/") and self.command == "GET":
+                    return self.send_json(200, {path.rsplit("/", 1)[-1]: {"processors": []}})
+                if path.endswith("/_mget"):
+                    request = json.loads(body or b"{}")
+                    ids = request.get("ids") or [doc.get("_id") for doc in request.get("docs", [])]
+                    docs = [{"_id": doc_id, "found": True, "_source": {"content_hash": fake.content_hashes[doc_id]}} if doc_id in fake.content_hashes else {"_id": doc_id, "found": False} for doc_id in ids]
+                    return self.send_json(200, {"docs": docs})
+                if path.endswith("/_search"):
+                    return self.send_json(200, {"took": 1, "timed_out": False, "hits": {"total": {"value": 0, "relation": "eq"}, "hits": []}})
+                if path.endswith("/_settings"):
+                    index = path.strip("/").split("/")[0]
+                    settings = fake.settings.setdefault(index, {"index.number_of_replicas": "1"})
+                    if self.command == "PUT":
+                        for name, value in json.loads(body).items():
+                            if value is None:
+                                settings.pop(name, None)
+                            else:
+                                settings[name] = str(value)
+                        return self.send_json(200, {"acknowledged": True})
+                    return self.send_json(200, {index: {"settings": dict(settings)}})
+                if self.command == "HEAD":
+                    return self.send_json(200)
+                return self.send_json(200, {"acknowledged": True})
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = route
+
+        return Handler
+
+def main(args):
+    fake = FakeElasticsearch(args.host, args.port, args.latency, args.per_doc_latency, args.reject_rate, args.capacity, args.seed)
+    print(f"Fake Elasticsearch listening on {fake.url} (stats at {fake.url}/_fake/stats)")
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(fake.metrics.summary(), indent=2))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a local stand-in for the Elasticsearch bulk and ingest endpoints")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=9200, help="Port to listen on")
+    parser.add_argument("--latency", type=float, default=0.0, help="Fixed latency in seconds per bulk request")
+    parser.add_argument("--per-doc-latency", type=float, default=0.0, help="Additional latency in seconds per document, e.g. to mimic ELSER inference")
+    parser.add_argument("--reject-rate", type=float, default=0.0, help="Share of bulk items randomly rejected with 429")
+    parser.add_argument("--capacity", type=int, default=0, help="Concurrent bulk requests accepted before items are rejected with 429 (0 = unlimited)")
+    parser.add_argument("--seed", type=int, help="Random seed for rejections")
+    args = parser.parse_args()
+
+    main(args)
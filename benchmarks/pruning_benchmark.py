@@ -0,0 +1,128 @@
+# pruning_benchmark.py
+import os
+import sys
+import json
+import time
+import argparse
+from statistics import mean, median
+from elasticsearch import Elasticsearch
+from dotenv import load_dotenv
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from query_expansion import expand_query, sparse_vector_query, pruned_tokens_rescore, DEFAULT_PRUNING
+
+load_dotenv(os.path.join(REPO_DIR, ".env"))
+
+DEFAULT_QUERIES = [
+    "persistent cough with wheezing",
+    "chest pain radiating to the left arm",
+    "recurring migraine with visual aura",
+    "itchy rash on both forearms",
+    "lower back pain after lifting",
+    "abdominal pain and bloating after meals",
+    "shortness of breath on exertion",
+    "low mood and trouble sleeping",
+    "fever and sore throat in a child",
+    "swollen painful knee joint"
+]
+
+def connect():
+    # Same connection settings as the ingest scripts: CLOUD_ID, or ELASTIC_URL when it's empty
+    cloud_id = os.getenv("CLOUD_ID")
+    connection = {"cloud_id": cloud_id} if cloud_id else {"hosts": os.getenv("ELASTIC_URL")}
+    return Elasticsearch(**connection, api_key=os.getenv("API_KEY"))
+
+def search_body(es, model_id, query, size, pruning):
+    body = {"size": size, "_source": False, "query": sparse_vector_query(es, model_id, query, pruning=pruning)}
+    rescore = pruned_tokens_rescore(es, model_id, query, pruning)
+    if rescore:
+        body["rescore"] = rescore
+    return body
+
+def run_query(es, index, body, repeat, warmup):
+    # The request cache is bypassed so every run is scored; the first `warmup` runs aren't timed
+    for _ in range(warmup):
+        es.search(index=index, body=body, request_cache=False)
+    took, latencies = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = es.search(index=index, body=body, request_cache=False)
+        latencies.append((time.perf_counter() - start) * 1000)
+        took.append(response["took"])
+    return [hit["_id"] for hit in response["hits"]["hits"]], median(took), median(latencies)
+
+def run_benchmark(es, args, queries):
+    pruning = {
+        "tokens_freq_ratio_threshold": args.freq_ratio,
+        "tokens_weight_threshold": args.weight_threshold,
+        "rescore_window_size": args.rescore_window_size
+    }
+    variants = {
+        "full": None,
+        "pruned": pruning,
+        "pruned+rescore": dict(pruning, rescore=True)
+    }
+    results = {name: {"took_ms": [], "latency_ms": [], "overlap": []} for name in variants}
+    for query in queries:
+        # Expanded once up front, so only the search itself is timed
+        expand_query(es, args.model_id, query)
+        baseline_ids = None
+        for name, variant in variants.items():
+            ids, took, latency = run_query(es, args.index, search_body(es, args.model_id, query, args.size, variant), args.repeat, args.warmup)
+            baseline_ids = baseline_ids if baseline_ids is not None else ids
+            result = results[name]
+            result["took_ms"].append(took)
+            result["latency_ms"].append(latency)
+            result["overlap"].append(len(set(ids) & set(baseline_ids)) / max(1, len(baseline_ids)))
+    return {
+        name: {
+            "queries": len(queries),
+            "p50_took_ms": median(result["took_ms"]),
+            "max_took_ms": max(result["took_ms"]),
+            "p50_latency_ms": median(result["latency_ms"]),
+            "mean_overlap": mean(result["overlap"]),
+            "min_overlap": min(result["overlap"])
+        }
+        for name, result in results.items()
+    }
+
+def print_results(summary, size):
+    print(f"{'variant':<16}{'p50 took':>10}{'max took':>10}{'p50 latency':>13}{f'overlap@{size}':>12}{'min overlap':>13}")
+    for name, result in summary.items():
+        print(f"{name:<16}{result['p50_took_ms']:>8.1f}ms{result['max_took_ms']:>8.1f}ms{result['p50_latency_ms']:>11.1f}ms"
+              f"{result['mean_overlap']:>12.2f}{result['min_overlap']:>13.2f}")
+
+def main(args):
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries, 'r') as file:
+            queries = [line.strip() for line in file if line.strip()]
+    es = connect()
+    summary = run_benchmark(es, args, queries)
+    print(f"{len(queries)} queries against '{args.index}', {args.repeat} timed runs each")
+    print_results(summary, args.size)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({"settings": vars(args), "results": summary}, file, indent=2)
+        print(f"Results saved to {args.output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare ELSER search latency and top-k overlap with and without query token pruning")
+    parser.add_argument("--index", type=str, default="notes-" + (os.getenv("INDEX_NAME") or "healthcare"), help="Index to search (default: notes-<INDEX_NAME>)")
+    parser.add_argument("--model-id", type=str, default=os.getenv("ELSER_MODEL") or ".elser_model_2", help="ELSER model used to expand the queries")
+    parser.add_argument("--queries", type=str, help="Text file with one query per line (default: a built-in set of clinical queries)")
+    parser.add_argument("--size", type=int, default=10, help="Number of hits compared between variants (k)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per query and variant; the median is reported")
+    parser.add_argument("--warmup", type=int, default=1, help="Untimed runs per query and variant")
+    parser.add_argument("--freq-ratio", type=float, default=DEFAULT_PRUNING["tokens_freq_ratio_threshold"], help="tokens_freq_ratio_threshold for the pruned variants")
+    parser.add_argument("--weight-threshold", type=float, default=DEFAULT_PRUNING["tokens_weight_threshold"], help="tokens_weight_threshold for the pruned variants")
+    parser.add_argument("--rescore-window-size", type=int, default=DEFAULT_PRUNING["rescore_window_size"], help="Hits rescored with the pruned tokens in the pruned+rescore variant")
+    parser.add_argument("--output", type=str, help="JSON file to save the results to")
+
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+
+    main(args)
@@ -0,0 +1,117 @@
+# blood_samples.py
+import string
+import numpy as np
+
+LAB_NUMBER_CHARS = np.frombuffer((string.ascii_uppercase + string.digits).encode(), dtype=np.uint8)
+LAB_NUMBER_LENGTH = 10
+
+LAB_LOCATIONS = ["Auckland", "Wellington", "Christchurch", "Hamilton", "Tauranga", "Napier-Hastings", "Dunedin", "Palmerston North", "Nelson", "Rotorua"]
+
+class BloodParameter:
+    def __init__(self, name, unit, lower_bound, upper_bound, field=None):
+        self.name = name
+        self.unit = unit
+        self.lower_bound = lower_bound
+        self.upper_bound = upper_bound
+        # Field name in the healthcare index
+        self.field = field or name.lower()
+
+    def is_within_range(self, value):
+        return self.lower_bound <= value <= self.upper_bound
+
+BLOOD_PARAMETERS = [
+    BloodParameter("Haemoglobin", "g/L", 130, 175),
+    BloodParameter("RBC", "x10¹²/L", 4.30, 6.00),
+    BloodParameter("HCT", "N/A", 0.40, 0.52),
+    BloodParameter("MCV", "fL", 80, 99),
+    BloodParameter("MCH", "pg", 27, 33.0),
+    BloodParameter("Platelets", "x10⁹/L", 150, 400),
+    BloodParameter("WBC", "x10⁹/L", 4.0, 11.0),
+    BloodParameter("Neutrophils", "x10⁹/L", 1.90, 7.50),
+    BloodParameter("Lymphocytes", "x10⁹/L", 1.00, 4.00),
+    BloodParameter("Monoocytes", "x10⁹/L", 0.20, 1.00, field="monocytes"),
+    BloodParameter("Eosinophils", "x10⁹/L", 0.00, 0.51),
+    BloodParameter("Basophils", "x10⁹/L", 0.00, 0.20)
+]
+
+class SampleBatch:
+    # Columnar samples for a block of patients. Every per-sample array is indexed
+    # [patient, year, sample] and `values`/`in_range` add a trailing parameter axis.
+    def __init__(self, parameters, years, values, in_range, months, days, lab_numbers):
+        self.parameters = parameters
+        self.years = years
+        self.values = values
+        self.in_range = in_range
+        self.months = months
+        self.days = days
+        self.lab_numbers = lab_numbers
+
+    @property
+    def num_patients(self):
+        return self.values.shape[0]
+
+    def measurements(self, patient, year_index, sample):
+        row = self.values[patient, year_index, sample].tolist()
+        return {param.name: value for param, value in zip(self.parameters, row)}
+
+    def within_range(self, patient, year_index, sample):
+        row = self.in_range[patient, year_index, sample].tolist()
+        return {param.name: flag for param, flag in zip(self.parameters, row)}
+
+    def collection_date(self, patient, year_index, sample):
+        return f"{self.days[patient, year_index, sample]:02d}/{self.months[patient, year_index, sample]:02d}/{self.years[year_index]}"
+
+    def lab_number(self, patient, year_index, sample):
+        return self.lab_numbers[patient, year_index, sample].decode()
+
+    def patient_samples(self, patient):
+        samples = []
+        for year_index, year in enumerate(self.years):
+            for sample in range(self.values.shape[2]):
+                samples.append((
+                    int(year),
+                    self.measurements(patient, year_index, sample),
+                    self.within_range(patient, year_index, sample),
+                    self.collection_date(patient, year_index, sample),
+                    self.lab_number(patient, year_index, sample)
+                ))
+        return samples
+
+def generate_sample_batch(parameters, num_patients, start_year, end_year, num_samples, percentage_min, percentage_max, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
+    years = np.arange(start_year, end_year + 1, dtype=np.int16)
+    shape = (num_patients, len(years), num_samples, len(parameters))
+
+    lower = np.array([param.lower_bound for param in parameters], dtype=np.float32)
+    upper = np.array([param.upper_bound for param in parameters], dtype=np.float32)
+    width = upper - lower
+
+    # One draw for both the range extension and the position inside the extended range,
+    # then work in place so peak memory stays at two float32 arrays of the output shape
+    draws = rng.random((2,) + shape, dtype=np.float32)
+    extension, values = draws[0], draws[1]
+    extension *= (percentage_max - percentage_min) / 100
+    extension += percentage_min / 100
+    extension *= width
+    values *= width + 2 * extension
+    values += lower
+    values -= extension
+    # Copy out so the batch doesn't keep the extension half of `draws` alive
+    values = values.copy()
+    del draws, extension
+
+    # Flagged against the float32 values the reports print, in one pass for the whole batch
+    in_range = (values >= lower) & (values <= upper)
+
+    months = rng.integers(1, 13, size=shape[:3], dtype=np.uint8)
+    days = rng.integers(1, 29, size=shape[:3], dtype=np.uint8)
+    lab_chars = LAB_NUMBER_CHARS[rng.integers(0, len(LAB_NUMBER_CHARS), size=shape[:3] + (LAB_NUMBER_LENGTH,))]
+    lab_numbers = np.ascontiguousarray(lab_chars).view(f"S{LAB_NUMBER_LENGTH}")[..., 0]
+
+    return SampleBatch(parameters, years, values, in_range, months, days, lab_numbers)
+
+def iter_sample_batches(parameters, num_patients, start_year, end_year, num_samples, percentage_min, percentage_max, seed=None, patients_per_batch=10000):
+    rng = np.random.default_rng(seed)
+    for start in range(0, num_patients, patients_per_batch):
+        batch_patients = min(patients_per_batch, num_patients - start)
+        yield generate_sample_batch(parameters, batch_patients, start_year, end_year, num_samples, percentage_min, percentage_max, rng)
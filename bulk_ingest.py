@@ -0,0 +1,292 @@
+# bulk_ingest.py
+import json
+import time
+import random
+import heapq
+import queue
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from elasticsearch import ApiError, ConnectionError as TransportConnectionError, ConnectionTimeout
+from elasticsearch.helpers import expand_action
+
+# Item and request statuses worth resending: rejections from a full write queue and transient node failures
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+REQUEST_TOO_LARGE = 413
+# Weight of the latest response in the smoothed rejection rate
+REJECTION_SMOOTHING = 0.3
+
+class BulkItem:
+    __slots__ = ("action", "lines", "size", "attempts")
+
+    def __init__(self, action):
+        self.action = action
+        header, source = expand_action(action)
+        self.lines = [json.dumps(header, separators=(',', ':')).encode('utf-8')]
+        if source is not None:
+            self.lines.append(source if isinstance(source, bytes) else json.dumps(source, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+        self.size = sum(len(line) + 1 for line in self.lines)
+        self.attempts = 0
+
+class BulkStats:
+    def __init__(self):
+        self.succeeded = 0
+        self.failed = 0
+        self.retried = 0
+        self.requests = 0
+        self.bytes_sent = 0
+        self.latencies = []
+        self.errors = Counter()
+        self.failures = Counter()
+        self.start_time = time.time()
+        self.end_time = None
+
+    @property
+    def elapsed(self):
+        return (self.end_time or time.time()) - self.start_time
+
+    def latency_percentile(self, percentile):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    def print_summary(self):
+        elapsed = max(self.elapsed, 1e-9)
+        print(f"Ingestion complete. Total succeeded: {self.succeeded}, Total failed: {self.failed}")
+        print(f"Elapsed: {elapsed:.1f}s ({(self.succeeded + self.failed) / elapsed:.1f} docs/sec, {self.bytes_sent / elapsed / 1024 / 1024:.2f} MB/sec)")
+        print(f"Bulk requests: {self.requests}, retried documents: {self.retried}, batch latency p50/p99: {self.latency_percentile(50):.2f}s/{self.latency_percentile(99):.2f}s")
+        if self.errors:
+            print("Errors by type (including retried attempts):")
+            for error_type, count in self.errors.most_common():
+                print(f"  {error_type}: {count} ({self.failures[error_type]} failed permanently)")
+
+class AdaptiveBulkIndexer:
+    def __init__(self, es, chunk_size=500, min_chunk_size=10, max_chunk_size=5000, max_chunk_bytes=10 * 1024 * 1024,
+                 concurrency=4, min_concurrency=1, max_concurrency=None, max_retries=5, initial_backoff=1, max_backoff=60,
+                 target_latency=10, rejection_threshold=0.25, request_timeout=300, on_success=None, on_failure=None, progress_every=1000):
+        # Retries are owned here, so the transport must not resend rejected bulk requests on its own
+        self.client = es.options(request_timeout=request_timeout, max_retries=0, retry_on_status=())
+        self.chunk_size = chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max(max_chunk_size, chunk_size)
+        self.max_chunk_bytes = max_chunk_bytes
+        self.concurrency = concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max(max_concurrency or concurrency * 2, concurrency)
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.target_latency = target_latency
+        self.rejection_threshold = rejection_threshold
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.progress_every = progress_every
+        self.chunk_step = max(1, chunk_size // 10)
+        self.clean_chunks = 0
+        self.last_decrease = 0
+        self.rejection_rate = 0.0
+        self.retry_queue = []  # heap of (ready_at, sequence, item)
+        self.retry_sequence = 0
+        self.stats = BulkStats()
+
+    def run(self, actions):
+        source = iter(actions)
+        source_exhausted = False
+        in_flight = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while True:
+                while len(in_flight) < self.concurrency:
+                    chunk, source_exhausted = self._next_chunk(source, source_exhausted)
+                    if not chunk:
+                        break
+                    in_flight[executor.submit(self._send, chunk)] = chunk
+
+                if not in_flight:
+                    if not self.retry_queue:
+                        if source_exhausted:
+                            break
+                        continue
+                    # Nothing to wait on but backed-off retries
+                    time.sleep(max(0, self.retry_queue[0][0] - time.time()))
+                    continue
+
+                # Waking up for a due retry only helps if there's a free slot to send it in; with every slot
+                # busy a zero timeout would spin until a request completes
+                timeout = None
+                if self.retry_queue and len(in_flight) < self.concurrency:
+                    timeout = max(0, self.retry_queue[0][0] - time.time())
+                done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chunk = in_flight.pop(future)
+                    self._handle_response(chunk, *future.result())
+
+        self.stats.end_time = time.time()
+        return self.stats
+
+    def _next_chunk(self, source, source_exhausted):
+        chunk = []
+        chunk_bytes = 0
+        now = time.time()
+
+        while self.retry_queue and self.retry_queue[0][0] <= now and len(chunk) < self.chunk_size:
+            item = self.retry_queue[0][2]
+            if chunk and chunk_bytes + item.size > self.max_chunk_bytes:
+                return chunk, source_exhausted
+            heapq.heappop(self.retry_queue)
+            chunk.append(item)
+            chunk_bytes += item.size
+
+        while not source_exhausted and len(chunk) < self.chunk_size:
+            try:
+                action = next(source)
+            except StopIteration:
+                source_exhausted = True
+                break
+            item = BulkItem(action)
+            chunk.append(item)
+            chunk_bytes += item.size
+            if chunk_bytes >= self.max_chunk_bytes:
+                break
+
+        return chunk, source_exhausted
+
+    def _send(self, chunk):
+        sent_at = time.time()
+        start = time.perf_counter()
+        try:
+            response = self.client.bulk(operations=[line for item in chunk for line in item.lines])
+            return response, None, time.perf_counter() - start, sent_at
+        except Exception as e:
+            return None, e, time.perf_counter() - start, sent_at
+
+    def _handle_response(self, chunk, response, error, latency, sent_at):
+        self.stats.requests += 1
+        self.stats.latencies.append(latency)
+        self.stats.bytes_sent += sum(item.size for item in chunk)
+        rejected = 0
+
+        if error is not None:
+            status = error.meta.status if isinstance(error, ApiError) else None
+            # Proxies can answer with HTML, so only trust the error type from a JSON error body
+            error_type = f"{status} {error.error if isinstance(error.body, dict) else type(error).__name__}" if status else type(error).__name__
+            if status == REQUEST_TOO_LARGE:
+                self.chunk_size = max(self.min_chunk_size, len(chunk) // 2)
+                self.max_chunk_bytes = max(1, self.max_chunk_bytes // 2)
+            if status in RETRYABLE_STATUSES or status == REQUEST_TOO_LARGE or isinstance(error, (TransportConnectionError, ConnectionTimeout)):
+                for item in chunk:
+                    self._retry(item, error_type)
+                rejected = len(chunk)
+            else:
+                for item in chunk:
+                    self._fail(item, error_type, str(error))
+        else:
+            for item, result in zip(chunk, response["items"]):
+                op_type, info = next(iter(result.items()))
+                status = info.get("status", 500)
+                if 200 <= status < 300:
+                    self.stats.succeeded += 1
+                    if self.on_success:
+                        self.on_success(info)
+                    self._report_progress()
+                    continue
+                error_type = f"{status} {info.get('error', {}).get('type', 'unknown')}"
+                if status in RETRYABLE_STATUSES:
+                    self._retry(item, error_type)
+                    rejected += 1
+                else:
+                    self._fail(item, error_type, info.get("error"))
+
+        self._adapt(len(chunk), rejected, latency, sent_at)
+
+    def _retry(self, item, error_type):
+        self.stats.errors[error_type] += 1
+        if item.attempts >= self.max_retries:
+            self._fail(item, error_type, f"gave up after {item.attempts} retries", counted=True)
+            return
+        item.attempts += 1
+        self.stats.retried += 1
+        # Exponential backoff with jitter so rejected items from parallel requests don't return in lockstep
+        backoff = min(self.max_backoff, self.initial_backoff * (2 ** (item.attempts - 1)))
+        ready_at = time.time() + backoff * random.uniform(0.5, 1.0)
+        self.retry_sequence += 1
+        heapq.heappush(self.retry_queue, (ready_at, self.retry_sequence, item))
+
+    def _fail(self, item, error_type, reason, counted=False):
+        if not counted:
+            self.stats.errors[error_type] += 1
+        self.stats.failures[error_type] += 1
+        self.stats.failed += 1
+        if self.on_failure:
+            self.on_failure(item.action, error_type, reason)
+        self._report_progress()
+
+    def _report_progress(self):
+        processed = self.stats.succeeded + self.stats.failed
+        if processed % self.progress_every == 0:
+            print(f"Processed {processed} documents ({self.stats.succeeded} succeeded, {self.stats.failed} failed, batch size {self.chunk_size}, concurrency {self.concurrency})")
+
+    def _adapt(self, chunk_length, rejected, latency, sent_at):
+        # A few rejected items are just retried; only a smoothed rejection rate above the threshold counts as congestion.
+        # Small chunks (e.g. a handful of retries) move the average less, so one unlucky item can't trigger a backoff.
+        weight = REJECTION_SMOOTHING * min(1, chunk_length / self.chunk_size)
+        self.rejection_rate += weight * (rejected / chunk_length - self.rejection_rate)
+        if rejected and self.rejection_rate > self.rejection_threshold:
+            self.clean_chunks = 0
+            # Requests already in flight when we last backed off report the same congestion, so react once per episode
+            if sent_at < self.last_decrease:
+                return
+            self.last_decrease = time.time()
+            # Multiplicative decrease, proportional to how much of the traffic the cluster is pushing back
+            self.chunk_size = max(self.min_chunk_size, int(self.chunk_size * max(0.5, 1 - self.rejection_rate)))
+            self.concurrency = max(self.min_concurrency, self.concurrency - 1)
+        elif latency > self.target_latency:
+            self.clean_chunks = 0
+            self.chunk_size = max(self.min_chunk_size, int(self.chunk_size * 0.75))
+        elif chunk_length >= self.chunk_size and latency < self.target_latency / 2:
+            # Additive increase while full chunks are accepted quickly and rejections stay below the threshold
+            self.clean_chunks += 1
+            self.chunk_size = min(self.max_chunk_size, self.chunk_size + self.chunk_step)
+            if self.clean_chunks % 5 == 0:
+                self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+
+def adaptive_bulk(es, actions, **options):
+    return AdaptiveBulkIndexer(es, **options).run(actions)
+
+def prefetch(iterable, buffer_size=1000):
+    # Build items on a background thread into a bounded buffer, so producing actions overlaps
+    # with waiting on bulk responses and memory stays at `buffer_size` items
+    buffer = queue.Queue(maxsize=buffer_size)
+    stopped = threading.Event()
+
+    def put(entry):
+        while not stopped.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception as e:
+            put((False, e))
+            return
+        put((False, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            has_item, item = buffer.get()
+            if not has_item:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stopped.set()
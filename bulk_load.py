@@ -0,0 +1,84 @@
+# bulk_load.py
+import os
+import json
+import signal
+from contextlib import contextmanager
+
+STATE_FILE_NAME = ".bulk-load-settings.json"
+
+# Settings relaxed while loading. Refreshes and replica copies are deferred until the load is done.
+BULK_LOAD_SETTINGS = {
+    "index.refresh_interval": "-1",
+    "index.number_of_replicas": 0
+}
+# Optional: fsync the translog in the background and flush less often, trading durability of the
+# last few seconds of writes for throughput. A crashed load is re-run anyway.
+TRANSLOG_SETTINGS = {
+    "index.translog.durability": "async",
+    "index.translog.sync_interval": "30s",
+    "index.translog.flush_threshold_size": "2gb"
+}
+
+def load_state(state_path):
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path, 'r') as file:
+        return json.load(file)
+
+def save_state(state_path, state):
+    # Written atomically so a crash can't leave a half-written record of the original settings
+    temp_path = f"{state_path}.tmp"
+    with open(temp_path, 'w') as file:
+        json.dump(state, file, indent=2)
+    os.replace(temp_path, state_path)
+
+def restore_settings(es, index, state_path=STATE_FILE_NAME):
+    state = load_state(state_path)
+    if index not in state:
+        return False
+    # Settings that were unset before the load are reset to their defaults with None
+    original = state.pop(index)
+    es.indices.put_settings(index=index, settings=original)
+    if state:
+        save_state(state_path, state)
+    else:
+        os.remove(state_path)
+    print(f"Restored original settings of '{index}': {original}")
+    return True
+
+@contextmanager
+def bulk_load_settings(es, index, translog=False, forcemerge=False, state_path=STATE_FILE_NAME):
+    # Settings left behind by a load that was killed outright (SIGKILL, lost VM) are put back first,
+    # otherwise they would be recorded as the "original" settings of this load
+    if restore_settings(es, index, state_path):
+        print(f"'{index}' was left with bulk-load settings by an earlier run")
+
+    tuned = dict(BULK_LOAD_SETTINGS, **(TRANSLOG_SETTINGS if translog else {}))
+    current = es.indices.get_settings(index=index, flat_settings=True)[index]["settings"]
+    original = {name: current.get(name) for name in tuned}
+
+    state = load_state(state_path)
+    state[index] = original
+    save_state(state_path, state)
+
+    # SIGTERM (e.g. from a job scheduler) would otherwise skip the finally block below
+    previous_handler = signal.getsignal(signal.SIGTERM)
+
+    def handle_sigterm(signum, frame):
+        raise SystemExit(128 + signum)
+
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    try:
+        es.indices.put_settings(index=index, settings=tuned)
+        print(f"Bulk-load settings applied to '{index}': {tuned}")
+        yield
+        if forcemerge:
+            # Merge before replicas are restored, so replicas copy the merged segments once
+            es.indices.refresh(index=index)
+            print(f"Force merging '{index}' to one segment, this may take a while...")
+            es.options(request_timeout=3600).indices.forcemerge(index=index, max_num_segments=1)
+            print(f"Force merge of '{index}' complete")
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        restore_settings(es, index, state_path)
+        es.indices.refresh(index=index)
@@ -0,0 +1,20 @@
+# enrichment.py
+
+# Bumped when the enrichment changes, so notes enriched by an older version are picked up again
+ENRICHMENT_VERSION = 1
+
+# Fields written onto notes by 4-enrich-clinical-notes.py, also mapped when the notes index is created
+ENRICHMENT_MAPPING = {
+    "entities": {
+        "properties": {
+            "entity": {"type": "keyword"},
+            "class_name": {"type": "keyword"}
+        }
+    },
+    "sentiment": {"type": "keyword"},
+    "sentiment_score": {"type": "float"},
+    "category": {"type": "keyword"},
+    "category_score": {"type": "float"},
+    "enrichment_version": {"type": "integer"},
+    "enriched_at": {"type": "date"}
+}
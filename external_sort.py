@@ -0,0 +1,44 @@
+# external_sort.py
+import os
+import csv
+import heapq
+import tempfile
+from itertools import islice
+
+def write_run(rows, directory, key=None):
+    file = tempfile.NamedTemporaryFile(mode='w', newline='', encoding='utf-8', dir=directory, suffix='.csv', delete=False)
+    with file:
+        csv.writer(file).writerows(sorted(rows, key=key) if key else rows)
+    return file.name
+
+def read_run(path):
+    with open(path, mode='r', newline='', encoding='utf-8') as file:
+        yield from csv.reader(file)
+
+def merge_runs(paths, key, directory, fan_in):
+    # Merge consecutive groups so no more than fan_in files are open at once; merging neighbours
+    # and heapq.merge preferring earlier inputs on ties keeps the sort stable
+    while len(paths) > fan_in:
+        merged = []
+        for start in range(0, len(paths), fan_in):
+            group = paths[start:start + fan_in]
+            merged.append(write_run(heapq.merge(*[read_run(path) for path in group], key=key), directory))
+            for path in group:
+                os.remove(path)
+        paths = merged
+    return heapq.merge(*[read_run(path) for path in paths], key=key)
+
+def external_sort(rows, key, run_size=100000, temp_dir=None, fan_in=64, on_run=None):
+    # Sorts an iterable of string rows that may not fit in memory: sorted runs of run_size rows are
+    # spilled to temporary CSV files and merged lazily. The files are removed once the result is exhausted or closed.
+    rows = iter(rows)
+    with tempfile.TemporaryDirectory(prefix="external-sort-", dir=temp_dir) as directory:
+        paths = []
+        while True:
+            run = list(islice(rows, run_size))
+            if not run:
+                break
+            paths.append(write_run(run, directory, key))
+            if on_run:
+                on_run(len(paths), len(run))
+        yield from merge_runs(paths, key, directory, fan_in)
@@ -0,0 +1,170 @@
+# identity.py
+import os
+import csv
+import random
+import string
+import argparse
+from collections import namedtuple
+from datetime import date, timedelta
+
+Identity = namedtuple("Identity", ["full_name", "address", "sex", "age", "dob", "nhi"])
+
+FIRST_NAMES = {
+    "male": [
+        "James", "Oliver", "Jack", "William", "Noah", "Leo", "George", "Thomas", "Lucas", "Mason",
+        "Hunter", "Charlie", "Liam", "Arlo", "Hugo", "Theodore", "Harrison", "Samuel", "Benjamin", "Max",
+        "Nikau", "Tama", "Wiremu", "Ari", "Mikaere", "Rangi", "Manaia", "Kahu", "Joshua", "Ethan",
+        "Daniel", "Ryan", "Connor", "Caleb", "Cooper", "Isaac", "Logan", "Jacob", "Finn", "Levi"
+    ],
+    "female": [
+        "Charlotte", "Isla", "Olivia", "Amelia", "Ava", "Mia", "Harper", "Sophie", "Ella", "Grace",
+        "Lily", "Zoe", "Emily", "Ruby", "Georgia", "Hazel", "Willow", "Isabella", "Evelyn", "Matilda",
+        "Aroha", "Maia", "Anahera", "Kaia", "Manaia", "Ataahua", "Mere", "Hine", "Chloe", "Hannah",
+        "Lucy", "Madison", "Jessica", "Emma", "Sarah", "Anna", "Maddison", "Holly", "Layla", "Stella"
+    ]
+}
+
+LAST_NAMES = [
+    "Smith", "Wilson", "Williams", "Brown", "Taylor", "Jones", "Anderson", "Thompson", "Walker", "Campbell",
+    "Stewart", "Robinson", "Clark", "Harris", "Martin", "Scott", "Young", "White", "Mitchell", "Edwards",
+    "King", "Wright", "Turner", "Baker", "Moore", "Cooper", "Kelly", "Watson", "Murray", "Hall",
+    "Ngata", "Parata", "Tipene", "Rewi", "Tamihana", "Rangihuna", "Henare", "Te Huia", "Wihongi", "Pomare",
+    "Singh", "Patel", "Chen", "Wang", "Li", "Kim", "Nguyen", "Fonoti", "Tuilagi", "Faleolo",
+    "Hughes", "Green", "Wood", "Roberts", "Thomson", "Morris", "Johnson", "Reid", "Ross", "Jackson",
+    "Bell", "Marshall", "Evans", "Lee", "Allen", "Hill", "Davis", "Davies", "Morgan", "Kennedy",
+    "Fraser", "Johnston", "Graham", "Miller", "Simpson", "Hamilton", "Moss", "Gray", "Cameron", "Hunt",
+    "Russell", "Duncan", "Ward", "Phillips", "Lewis", "Paterson", "Watts", "Carter", "Gordon", "Shaw",
+    "Fisher", "Mason", "Brooks", "Stevens", "Barnes", "Webb", "Palmer", "Ryan", "Sullivan", "Bennett",
+    "McDonald", "McKenzie", "MacLeod", "McLean", "O'Brien", "O'Connor", "Gillespie", "Sutherland", "Ferguson", "Munro",
+    "Tawhiri", "Karaka", "Herewini", "Paewai", "Kereama", "Te Whata", "Waaka", "Tuhiwai", "Potae", "Hohaia",
+    "Leaupepe", "Sapolu", "Fifita", "Taufa", "Vaipulu", "Ioane", "Mahe", "Tupou", "Latu", "Fuimaono",
+    "Zhang", "Liu", "Huang", "Wu", "Sharma", "Kumar", "Reddy", "Park", "Choi", "Tran"
+]
+
+# A middle initial multiplies the distinct names by 26, so large runs rarely repeat a name
+MIDDLE_INITIALS = string.ascii_uppercase
+
+STREET_NAMES = [
+    "Queen Street", "Victoria Street", "Ponsonby Road", "Karangahape Road", "Dominion Road", "Great North Road",
+    "Lambton Quay", "Cuba Street", "Riccarton Road", "Colombo Street", "George Street", "Princes Street",
+    "Grey Street", "Cameron Road", "Tenth Avenue", "Devon Street", "Emerson Street", "Trafalgar Street",
+    "Main Street", "Church Street", "Station Road", "Beach Road", "Park Avenue", "Hill Street",
+    "Kowhai Street", "Rimu Road", "Totara Avenue", "Matai Street", "Puriri Street", "Nikau Street"
+]
+
+# (city, region, lowest postcode, highest postcode)
+NZ_LOCATIONS = [
+    ("Auckland", "Auckland", 600, 2699),
+    ("Hamilton", "Waikato", 3200, 3299),
+    ("Tauranga", "Bay of Plenty", 3110, 3119),
+    ("Rotorua", "Bay of Plenty", 3010, 3020),
+    ("Gisborne", "Gisborne", 4010, 4010),
+    ("Napier", "Hawke's Bay", 4104, 4112),
+    ("Hastings", "Hawke's Bay", 4120, 4130),
+    ("New Plymouth", "Taranaki", 4310, 4312),
+    ("Whanganui", "Manawatu-Wanganui", 4500, 4501),
+    ("Palmerston North", "Manawatu-Wanganui", 4410, 4414),
+    ("Wellington", "Wellington", 6011, 6037),
+    ("Lower Hutt", "Wellington", 5010, 5019),
+    ("Whangarei", "Northland", 110, 112),
+    ("Nelson", "Nelson", 7010, 7011),
+    ("Blenheim", "Marlborough", 7201, 7201),
+    ("Christchurch", "Canterbury", 8011, 8083),
+    ("Timaru", "Canterbury", 7910, 7910),
+    ("Dunedin", "Otago", 9010, 9019),
+    ("Queenstown", "Otago", 9300, 9300),
+    ("Invercargill", "Southland", 9810, 9812)
+]
+
+NHI_CHARS = string.ascii_uppercase + string.digits
+
+MIN_AGE = 18
+MAX_AGE = 90
+
+# Seeded runs date births back from a fixed day instead of today, so the same seed gives the same DOBs and ages on any day
+SEEDED_REFERENCE_DATE = date(2024, 1, 1)
+
+def reference_date(seed):
+    return SEEDED_REFERENCE_DATE if seed is not None else date.today()
+
+def generate_identities(count, seed=None, rng=None, today=None):
+    rng = rng or random.Random(seed)
+    today = today or reference_date(seed)
+
+    sexes = rng.choices(("male", "female"), k=count)
+    middle_initials = rng.choices(MIDDLE_INITIALS, k=count)
+    last_names = rng.choices(LAST_NAMES, k=count)
+    street_numbers = rng.choices(range(1, 1000), k=count)
+    streets = rng.choices(STREET_NAMES, k=count)
+    locations = rng.choices(NZ_LOCATIONS, k=count)
+    day_offsets = rng.choices(range(MIN_AGE * 365, MAX_AGE * 365), k=count)
+    nhi_chars = rng.choices(NHI_CHARS, k=count * 7)
+
+    identities = []
+    for i in range(count):
+        sex = sexes[i]
+        full_name = f"{rng.choice(FIRST_NAMES[sex])} {middle_initials[i]}. {last_names[i]}"
+        city, region, postcode_min, postcode_max = locations[i]
+        postcode = f"{rng.randint(postcode_min, postcode_max):04d}"
+        address = f"{street_numbers[i]} {streets[i]}, {city}, {postcode}, {region}, New Zealand"
+        dob = today - timedelta(days=day_offsets[i])
+        age = today.year - dob.year - ((today.month, today.day) < (dob.month, dob.day))
+        nhi = ''.join(nhi_chars[i * 7:(i + 1) * 7])
+        identities.append(Identity(full_name, address, sex, age, dob.isoformat(), nhi))
+    return identities
+
+def load_identity_pool(path):
+    with open(path, mode='r', newline='') as file:
+        reader = csv.DictReader(file)
+        return [Identity(row['full_name'], row['address'], row['sex'], int(row['age']), row['dob'], row['nhi']) for row in reader]
+
+def draw_identities(count, seed=None, pool_path=None):
+    rng = random.Random(seed)
+    if not pool_path:
+        return generate_identities(count, rng=rng, today=reference_date(seed))
+
+    pool = load_identity_pool(pool_path)
+    if not pool:
+        raise ValueError(f"Identity pool '{pool_path}' is empty")
+    if count <= len(pool):
+        return rng.sample(pool, count)
+    return rng.choices(pool, k=count)
+
+def stream_identities(seed=None, pool_path=None, rng=None, chunk_size=10000):
+    # Endless supply of identities, generated (or drawn from the pool) one chunk at a time
+    rng = rng or random.Random(seed)
+    today = reference_date(seed)
+    pool = load_identity_pool(pool_path) if pool_path else None
+    if pool_path and not pool:
+        raise ValueError(f"Identity pool '{pool_path}' is empty")
+    while True:
+        if pool:
+            # Each pass hands out every pool identity once, so runs no larger than the pool get distinct
+            # patients, as with draw_identities
+            rng.shuffle(pool)
+            yield from pool
+        else:
+            yield from generate_identities(chunk_size, rng=rng, today=today)
+
+def main(count, seed, output, chunk_size):
+    if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+
+    rng = random.Random(seed)
+    with open(output, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(Identity._fields)
+        for start in range(0, count, chunk_size):
+            writer.writerows(generate_identities(min(chunk_size, count - start), rng=rng, today=reference_date(seed)))
+    print(f"Saved {count} identities to {output}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pre-generate a reusable pool of synthetic NZ patient identities.")
+    parser.add_argument("--count", type=int, required=True, help="Number of identities to generate")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible identities")
+    parser.add_argument("--output", type=str, default="identities.csv", help="CSV file to write the identity pool to")
+    parser.add_argument("--chunk-size", type=int, default=10000, help="Number of identities generated per batch")
+
+    args = parser.parse_args()
+
+    main(args.count, args.seed, args.output, args.chunk_size)
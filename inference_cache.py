@@ -0,0 +1,115 @@
+# inference_cache.py
+import os
+import json
+import time
+import sqlite3
+import threading
+from cachetools import TTLCache
+from dotenv import load_dotenv
+
+class DiskCache:
+    # Optional second level that survives restarts. Entries older than ttl are ignored and the least
+    # recently used ones are deleted once there are more than maxsize.
+    def __init__(self, path, maxsize=100000, ttl=86400):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        self.connection.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                return None
+            self.connection.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (key, json.dumps(value), now, now))
+            self.connection.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.maxsize,)
+            )
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute("DELETE FROM cache")
+            self.connection.commit()
+
+class InferenceCache:
+    # Bounded LRU cache with a TTL for inference results, keyed on (model_id, text, labels)
+    def __init__(self, maxsize=10000, ttl=3600, disk_path=None, disk_maxsize=100000):
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.disk = DiskCache(disk_path, disk_maxsize, ttl) if disk_path else None
+        # cachetools caches aren't thread-safe, and "All Analyses" infers from several threads
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            maxsize=int(os.getenv("INFERENCE_CACHE_SIZE", 10000)),
+            ttl=float(os.getenv("INFERENCE_CACHE_TTL", 3600)),
+            disk_path=os.getenv("INFERENCE_CACHE_PATH") or None,
+            disk_maxsize=int(os.getenv("INFERENCE_CACHE_DISK_SIZE", 100000))
+        )
+
+    @staticmethod
+    def key(model_id, text, labels=None):
+        return (model_id, text, tuple(labels) if labels else None)
+
+    def get(self, key):
+        with self.lock:
+            value = self.memory.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+        value = self.disk.get(json.dumps(key)) if self.disk else None
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.memory[key] = value
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.memory[key] = value
+        if self.disk:
+            self.disk.set(json.dumps(key), value)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.hits = self.disk_hits = self.misses = 0
+        if self.disk:
+            self.disk.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                "entries": len(self.memory),
+                "max_entries": self.memory.maxsize,
+                "ttl_seconds": self.memory.ttl
+            }
+
+# Shared by the app's inference calls; configured with INFERENCE_CACHE_SIZE, INFERENCE_CACHE_TTL and,
+# for the optional disk layer, INFERENCE_CACHE_PATH and INFERENCE_CACHE_DISK_SIZE
+# Imported before main.py loads .env, so the settings are loaded here first
+load_dotenv()
+inference_cache = InferenceCache.from_env()
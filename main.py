@@ -3,10 +3,14 @@ from elasticsearch import Elasticsearch
 from dotenv import load_dotenv
 from openai import OpenAI
 import os
-from text_analysis import perform_text_analysis
-from search import perform_search
+import json
+from text_analysis import perform_text_analysis, analyze_many, ALL_ANALYSES
+from search import perform_search, RRF_RANK_WINDOW_SIZE, RRF_RANK_CONSTANT
 from rag_search import perform_rag_search
 from rag_search_notes import perform_rag_search_notes
+from model_warmup import warm_up_models
+from inference_cache import inference_cache
+from query_expansion import expansion_cache, pruning_from_env, DEFAULT_PRUNING
 from datetime import datetime
 from operator import itemgetter
 
@@ -31,6 +35,9 @@ MODEL_MAP = {
     "Zero Shot Recognition": ZERO_SHOT_MODEL
 }
 
+# Set WARMUP_ON_STARTUP=false to skip warming up the models when the app starts
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "true").lower() != "false"
+
 index_name_mapping = {
     "Blood Tests": "healthcare",
     "GP": "notes-healthcare",
@@ -72,6 +79,26 @@ def display_results(results, sort_field, sort_order):
         st.write("No results found.")
 
 
+@st.cache_resource(show_spinner="Warming up models...")
+def warm_up():
+    # Cached for the server process, so only the first session after startup pays the cold-start cost
+    return warm_up_models(es, dict(MODEL_MAP, ELSER=ELSER_MODEL))
+
+
+def display_model_readiness(warmup_results):
+    st.sidebar.subheader("Model readiness")
+    if warmup_results is None:
+        st.sidebar.write("Models have not been warmed up yet.")
+        return
+    for name, result in warmup_results.items():
+        if result["status"] == "ready":
+            st.sidebar.write(f"✅ **{name}**: cold {result['cold_ms']:.0f} ms, warm {result['warm_ms']:.0f} ms")
+        else:
+            st.sidebar.write(f"❌ **{name}**: not ready")
+            if debug_mode:
+                st.sidebar.caption(result["error"])
+
+
 def get_date_range(es, index_name):
     try:
         body = {
@@ -116,6 +143,29 @@ INDEX_NAME = index_name_mapping.get(sub_category, "default-index")
 
 debug_mode = st.sidebar.checkbox("Enable Debug Mode")
 
+# Applies to ELSER, Hybrid and RAG searches; the defaults come from ELSER_PRUNING and related env vars
+pruning_defaults = pruning_from_env() or DEFAULT_PRUNING
+with st.sidebar.expander("ELSER token pruning"):
+    prune_tokens = st.checkbox("Prune low-weight query tokens", value=pruning_from_env() is not None)
+    freq_ratio = st.number_input("Token frequency ratio threshold", min_value=1.0, max_value=100.0, value=float(pruning_defaults["tokens_freq_ratio_threshold"]))
+    weight_threshold = st.number_input("Token weight threshold", min_value=0.0, max_value=1.0, value=float(pruning_defaults["tokens_weight_threshold"]), step=0.05)
+    rescore_pruned = st.checkbox("Rescore top hits with the pruned tokens", value=pruning_defaults["rescore"])
+pruning = {
+    "tokens_freq_ratio_threshold": freq_ratio,
+    "tokens_weight_threshold": weight_threshold,
+    "rescore": rescore_pruned,
+    "rescore_window_size": pruning_defaults["rescore_window_size"]
+} if prune_tokens else None
+
+if st.sidebar.button("Warm Up Models"):
+    warm_up.clear()
+    st.session_state.models_warmed = True
+
+if WARMUP_ON_STARTUP or st.session_state.get("models_warmed"):
+    display_model_readiness(warm_up())
+else:
+    display_model_readiness(None)
+
 col1, col2, col3 = st.columns(3)
 for col in (col1, col2, col3):
     with col:
@@ -132,15 +182,26 @@ tab1, tab2, tab3 = st.tabs(["Text Analysis", "Search", "RAG"])
 with tab1:
     st.session_state.current_tab = "Text Analysis"
     
-    analysis_type = st.selectbox("Choose analysis type", list(MODEL_MAP.keys()))
+    analysis_type = st.selectbox("Choose analysis type", list(MODEL_MAP.keys()) + [ALL_ANALYSES])
     
     text_input = st.text_area("Enter text for analysis")
+
+    uploaded_file = st.file_uploader("Or upload a file of texts to analyze, one per line", type=["txt", "csv"])
     
     if st.button("Analyze"):
-        selected_model = MODEL_MAP[analysis_type]
+        selected_model = MODEL_MAP if analysis_type == ALL_ANALYSES else MODEL_MAP[analysis_type]
         
-        result = perform_text_analysis(analysis_type, text_input, es, selected_model)
-        st.write(result)
+        if uploaded_file is not None:
+            texts = [line.strip() for line in uploaded_file.getvalue().decode("utf-8").splitlines() if line.strip()]
+            with st.spinner(f"Analyzing {len(texts)} texts..."):
+                results = analyze_many(analysis_type, texts, es, selected_model)
+            rows = [{"Text": text, "Result": result} for text, result in zip(texts, results)]
+            st.dataframe(rows, use_container_width=True)
+            results_output = "\n".join(json.dumps(row, ensure_ascii=False) for row in rows)
+            st.download_button("Download results (JSON lines)", results_output, file_name="text-analysis-results.jsonl")
+        else:
+            result = perform_text_analysis(analysis_type, text_input, es, selected_model)
+            st.write(result)
 
 with tab2:
     st.session_state.current_tab = "Search"
@@ -158,13 +219,21 @@ with tab2:
     with col2:
         end_date = st.date_input("End Date", min_value=min_date, max_value=max_date, value=max_date)
     
-    search_type = st.radio("Choose search type", ["Text Search", "ELSER Search", "Hybrid Search"])
+    search_type = st.radio("Choose search type", ["Text Search", "ELSER Search", "Hybrid Search", "RRF Search"])
+
+    rank_window_size, rank_constant = RRF_RANK_WINDOW_SIZE, RRF_RANK_CONSTANT
+    if search_type == "RRF Search":
+        col1, col2 = st.columns(2)
+        with col1:
+            rank_window_size = st.number_input("Rank window size", min_value=20, max_value=10000, value=RRF_RANK_WINDOW_SIZE)
+        with col2:
+            rank_constant = st.number_input("Rank constant", min_value=1, max_value=1000, value=RRF_RANK_CONSTANT)
     
     sort_field = st.selectbox("Sort by", ["Patient name", "Note Date", "NHI"])
     sort_order = st.radio("Sort order", ["Ascending", "Descending"])
     
     if st.button("Search"):
-        results = perform_search(search_type, search_query, es, INDEX_NAME, ELSER_MODEL, start_date, end_date)
+        results = perform_search(search_type, search_query, es, INDEX_NAME, ELSER_MODEL, start_date, end_date, pruning, rank_window_size, rank_constant)
         
         st.subheader(f"{search_type} Results")
         display_results(results, sort_field, sort_order)
@@ -197,10 +266,10 @@ with tab3:
             
             # Determine which function to call based on INDEX_NAME
             if INDEX_NAME == "notes-healthcare":
-                esql_query, response = perform_rag_search_notes(prompt, es, openai_client, INDEX_NAME, ELSER_MODEL)
+                esql_query, response = perform_rag_search_notes(prompt, es, openai_client, INDEX_NAME, ELSER_MODEL, pruning)
                 print("HIT::: " + INDEX_NAME )
             elif INDEX_NAME == "healthcare":
-                esql_query, response = perform_rag_search(prompt, es, openai_client, INDEX_NAME, ELSER_MODEL)
+                esql_query, response = perform_rag_search(prompt, es, openai_client, INDEX_NAME, ELSER_MODEL, pruning)
                 print("HIT::: " + INDEX_NAME )
             else:
                 esql_query, response = None, "Invalid INDEX_NAME"
@@ -230,5 +299,13 @@ if st.sidebar.button("Reset Date Range"):
 
 if debug_mode:
     st.sidebar.title("Debug Information")
+    st.sidebar.subheader("Inference cache")
+    st.sidebar.json(inference_cache.stats())
+    if st.sidebar.button("Clear Inference Cache"):
+        inference_cache.clear()
+    st.sidebar.subheader("Query expansion cache")
+    st.sidebar.json(expansion_cache.stats())
+    if st.sidebar.button("Clear Query Expansion Cache"):
+        expansion_cache.clear()
     st.sidebar.json(st.session_state.to_dict())
 
@@ -0,0 +1,37 @@
+# model_warmup.py
+import time
+from statistics import median
+from concurrent.futures import ThreadPoolExecutor
+from text_analysis import ZERO_SHOT_CATEGORIES
+
+# Representative inputs, close to what the demo sends, so warm-up exercises the same code paths and lengths
+WARMUP_TEXTS = {
+    "Named Entity Recognition": "My name is Banjo from Philippines, and I work for Elastic",
+    "Sentiment Analysis": "I feel a little awesome today, but my co-worker is having a bad day",
+    "Zero Shot Recognition": "Please help! I'm running out of battery",
+    "ELSER": "patient with persistent cough, wheezing and low-grade fever"
+}
+
+def infer_once(es, model_id, text, labels=None):
+    inference_config = {"zero_shot_classification": {"labels": labels}} if labels else None
+    start = time.perf_counter()
+    es.ml.infer_trained_model(model_id=model_id, docs=[{"text_field": text}], inference_config=inference_config, timeout="60s")
+    return (time.perf_counter() - start) * 1000
+
+def warm_up_model(es, name, model_id, warm_runs=3):
+    # The first request after a deployment starts loads the model onto the ML node's threads; the
+    # following ones show the latency users will actually see
+    labels = ZERO_SHOT_CATEGORIES if name == "Zero Shot Recognition" else None
+    text = WARMUP_TEXTS.get(name, WARMUP_TEXTS["ELSER"])
+    try:
+        cold_ms = infer_once(es, model_id, text, labels)
+        warm_ms = median(infer_once(es, model_id, text, labels) for _ in range(warm_runs))
+        return {"model_id": model_id, "status": "ready", "cold_ms": cold_ms, "warm_ms": warm_ms, "checked_at": time.time()}
+    except Exception as e:
+        return {"model_id": model_id, "status": "error", "error": str(e), "checked_at": time.time()}
+
+def warm_up_models(es, models, warm_runs=3):
+    # models maps a display name to a model id; all models are warmed up side by side
+    with ThreadPoolExecutor(max_workers=max(1, len(models))) as executor:
+        futures = {name: executor.submit(warm_up_model, es, name, model_id, warm_runs) for name, model_id in models.items()}
+        return {name: future.result() for name, future in futures.items()}
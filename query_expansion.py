@@ -0,0 +1,69 @@
+# query_expansion.py
+import os
+import re
+from inference_cache import InferenceCache
+from text_analysis import infer_batch
+from dotenv import load_dotenv
+
+# Read at import time, before main.py loads .env
+load_dotenv()
+
+# ELSER expansions of search queries; kept apart from inference_cache so analysis results can't evict them.
+# Configured with QUERY_EXPANSION_CACHE_SIZE and QUERY_EXPANSION_CACHE_TTL.
+expansion_cache = InferenceCache(
+    maxsize=int(os.getenv("QUERY_EXPANSION_CACHE_SIZE", 5000)),
+    ttl=float(os.getenv("QUERY_EXPANSION_CACHE_TTL", 86400))
+)
+
+# Query-time ELSER token pruning, off unless ELSER_PRUNING is set. Tokens that occur far more often in the
+# field than the average token (tokens_freq_ratio_threshold times) and weigh less than tokens_weight_threshold
+# are dropped. Those tokens match most documents, which is where most of the cost of an expansion goes.
+DEFAULT_PRUNING = {
+    "tokens_freq_ratio_threshold": 5,
+    "tokens_weight_threshold": 0.4,
+    "rescore": False,
+    "rescore_window_size": 100
+}
+
+def pruning_from_env():
+    if os.getenv("ELSER_PRUNING", "false").lower() != "true":
+        return None
+    return {
+        "tokens_freq_ratio_threshold": float(os.getenv("ELSER_PRUNING_FREQ_RATIO", DEFAULT_PRUNING["tokens_freq_ratio_threshold"])),
+        "tokens_weight_threshold": float(os.getenv("ELSER_PRUNING_WEIGHT_THRESHOLD", DEFAULT_PRUNING["tokens_weight_threshold"])),
+        "rescore": os.getenv("ELSER_PRUNING_RESCORE", "false").lower() == "true",
+        "rescore_window_size": int(os.getenv("ELSER_PRUNING_RESCORE_WINDOW", DEFAULT_PRUNING["rescore_window_size"]))
+    }
+
+def normalize_query(query):
+    # ELSER's tokenizer lowercases anyway, so these variants expand to the same tokens
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+def expand_query(es, model_id, query, cache=expansion_cache):
+    # Returns ELSER's token -> weight map for the query, inferring only on a cache miss
+    result = infer_batch(es, model_id, [normalize_query(query)], cache=cache)[0]
+    if "predicted_value" not in result:
+        raise ValueError(f"ELSER could not expand the query: {result.get('warning', result)}")
+    return result["predicted_value"]
+
+def sparse_vector_query(es, model_id, query, field="text_embedding", pruning=None):
+    # Scores the same as text_expansion with model_text, but with the tokens computed up front
+    clause = {"field": field, "query_vector": expand_query(es, model_id, query)}
+    if pruning:
+        clause["prune"] = True
+        clause["pruning_config"] = {
+            "tokens_freq_ratio_threshold": pruning.get("tokens_freq_ratio_threshold", DEFAULT_PRUNING["tokens_freq_ratio_threshold"]),
+            "tokens_weight_threshold": pruning.get("tokens_weight_threshold", DEFAULT_PRUNING["tokens_weight_threshold"]),
+            "only_score_pruned_tokens": pruning.get("only_score_pruned_tokens", False)
+        }
+    return {"sparse_vector": clause}
+
+def pruned_tokens_rescore(es, model_id, query, pruning, field="text_embedding"):
+    # Adds the scores of the pruned tokens back for the top window_size hits, so they rank close to
+    # an unpruned query while the full token list is only evaluated on a few documents
+    if not pruning or not pruning.get("rescore"):
+        return None
+    return {
+        "window_size": pruning.get("rescore_window_size", DEFAULT_PRUNING["rescore_window_size"]),
+        "query": {"rescore_query": sparse_vector_query(es, model_id, query, field, dict(pruning, only_score_pruned_tokens=True))}
+    }
@@ -2,10 +2,13 @@
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
+from query_expansion import sparse_vector_query, pruned_tokens_rescore
 
+# Every returned field goes into the LLM context, so the sparse embedding and the PDF attachment metadata are left out
+CONTEXT_SOURCE_EXCLUDES = ["text_embedding", "attachment"]
 
 
-def perform_rag_search(query, es, openai_client, index_name, model_id):
+def perform_rag_search(query, es, openai_client, index_name, model_id, pruning=None):
     print("DEBUG:: " + query)
     query_type, visualization_type = classify_query(query, openai_client)
     print("DEBUG:: query_type: " + str(query_type) + ' ' + "visaulization_type: " + str(visualization_type))
@@ -16,7 +19,7 @@ def perform_rag_search(query, es, openai_client, index_name, model_id):
         return esql_query, response
     else:
         # Proceed with regular RAG search
-        context = retrieve_documents(query, es, index_name, model_id)
+        context = retrieve_documents(query, es, index_name, model_id, pruning)
         print("DEBUG: context: " + context )
         return None, generate_response(context, query, openai_client)
 
@@ -235,21 +238,15 @@ def execute_esql(esql_query, es):
         
         return None
 
-def retrieve_documents(query, es, index_name, model_id):
+def retrieve_documents(query, es, index_name, model_id, pruning=None):
     print("Query: " + query + " index_name " + index_name + " model_id: " + model_id)
     body = {
         "size": 5,
+        "_source": {"excludes": CONTEXT_SOURCE_EXCLUDES},
         "query": {
             "bool": {
                 "should": [
-                    {
-                        "text_expansion": {
-                            "text_embedding": {
-                                "model_id": model_id,
-                                "model_text": query
-                            }
-                        }
-                    },
+                    sparse_vector_query(es, model_id, query, pruning=pruning),
                     {
                         "multi_match": {
                             "query": query,
@@ -278,6 +275,9 @@ def retrieve_documents(query, es, index_name, model_id):
             }
         }
     }
+    rescore = pruned_tokens_rescore(es, model_id, query, pruning)
+    if rescore:
+        body["rescore"] = rescore
     response = es.search(index=index_name, body=body)
     print("DEBUG:: " + str(response))
     
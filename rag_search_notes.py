@@ -1,7 +1,8 @@
 # rag_search_notes.py
+from query_expansion import sparse_vector_query, pruned_tokens_rescore
 
-def perform_rag_search_notes(query, es, openai_client, index_name, model_id):
-    response = retrieve_documents(query, es, openai_client, index_name, model_id)
+def perform_rag_search_notes(query, es, openai_client, index_name, model_id, pruning=None):
+    response = retrieve_documents(query, es, openai_client, index_name, model_id, pruning)
     context = extract_clinical_notes(response)
     return None, generate_response(context, query, openai_client)
 
@@ -22,24 +23,22 @@ def extract_clinical_notes(response):
     print("DEBUG:::::::::" + combined_notes)
     return combined_notes
 
-def retrieve_documents(query, es, openai_client, index_name, model_id):
+def retrieve_documents(query, es, openai_client, index_name, model_id, pruning=None):
     body = {
         "size": 5,
+        # extract_clinical_notes only reads these two fields
+        "_source": ["condition", "clinical_note"],
         "query": {
             "bool": {
                 "should": [
-                    {
-                        "text_expansion": {
-                            "text_embedding": {
-                                "model_id": model_id,
-                                "model_text": query
-                            }
-                        }
-                    }
+                    sparse_vector_query(es, model_id, query, pruning=pruning)
                 ]
             }
         }
     }
+    rescore = pruned_tokens_rescore(es, model_id, query, pruning)
+    if rescore:
+        body["rescore"] = rescore
     response = es.search(index=index_name, body=body)
     return response
 
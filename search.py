@@ -1,14 +1,24 @@
 from datetime import datetime
+from query_expansion import sparse_vector_query, pruned_tokens_rescore
 
-def perform_search(search_type, query, es, index_name, model_id, start_date, end_date):
+# Only the fields process_results shows are fetched; text_embedding alone is thousands of token weights per hit
+RESULT_FIELDS = ["patient_name", "nhi", "dob", "gp", "condition", "note_date", "clinical_note"]
+
+# Reciprocal rank fusion: each retriever contributes its top rank_window_size hits, scored 1 / (rank_constant + rank).
+# A larger rank_constant gives lower-ranked hits more say.
+RRF_RANK_WINDOW_SIZE = 100
+RRF_RANK_CONSTANT = 60
+
+def perform_search(search_type, query, es, index_name, model_id, start_date, end_date, pruning=None, rank_window_size=RRF_RANK_WINDOW_SIZE, rank_constant=RRF_RANK_CONSTANT):
+    # pruning turns on ELSER token pruning for the searches that expand the query, see query_expansion.DEFAULT_PRUNING
     if search_type == "Text Search":
         return text_search(query, es, index_name, start_date, end_date)
     elif search_type == "RRF Search":
-        return rrf_search(query, es, index_name, start_date, end_date)
+        return rrf_search(query, es, index_name, model_id, start_date, end_date, pruning, rank_window_size, rank_constant)
     elif search_type == "ELSER Search":
-        return elser_search(query, es, index_name, model_id, start_date, end_date)
+        return elser_search(query, es, index_name, model_id, start_date, end_date, pruning)
     elif search_type == "Hybrid Search":
-        return hybrid_search(query, es, index_name, model_id, start_date, end_date)
+        return hybrid_search(query, es, index_name, model_id, start_date, end_date, pruning)
     else:
         return "Invalid search type"
 
@@ -37,6 +47,7 @@ def text_search(query, es, index_name, start_date, end_date):
                     "minimum_should_match": 1
                 }
             },
+            "_source": RESULT_FIELDS,
             "highlight": {
                 "fields": {
                     "clinical_note": {},
@@ -51,17 +62,10 @@ def text_search(query, es, index_name, start_date, end_date):
     except Exception as e:
         return f"Error performing Text Search: {str(e)}"
 
-def elser_search(query, es, index_name, model_id, start_date, end_date):
+def elser_search(query, es, index_name, model_id, start_date, end_date, pruning=None):
     try:
         must_conditions = [
-            {
-                "text_expansion": {
-                    "text_embedding": {
-                        "model_id": model_id,
-                        "model_text": query
-                    }
-                }
-            },
+            sparse_vector_query(es, model_id, query, pruning=pruning),
             {"range": {"note_date": {"gte": start_date.isoformat(), "lte": end_date.isoformat()}}}
         ]
         
@@ -71,6 +75,7 @@ def elser_search(query, es, index_name, model_id, start_date, end_date):
                     "must": must_conditions
                 }
             },
+            "_source": RESULT_FIELDS,
             "highlight": {
                 "fields": {
                     "clinical_note": {},
@@ -80,26 +85,22 @@ def elser_search(query, es, index_name, model_id, start_date, end_date):
                 }
             }
         }
+        rescore = pruned_tokens_rescore(es, model_id, query, pruning)
+        if rescore:
+            body["rescore"] = rescore
         response = es.search(index=index_name, body=body)
         return process_results(response, include_highlights=True)
     except Exception as e:
         return f"Error performing ELSER Search: {str(e)}"
 
-def hybrid_search(query, es, index_name, model_id, start_date, end_date):
+def hybrid_search(query, es, index_name, model_id, start_date, end_date, pruning=None):
     try:
         must_conditions = [
             {
                 "bool": {
                     "should": [
                         {"match": {"clinical_note": query}},
-                        {
-                            "text_expansion": {
-                                "text_embedding": {
-                                    "model_id": model_id,
-                                    "model_text": query
-                                }
-                            }
-                        }
+                        sparse_vector_query(es, model_id, query, pruning=pruning)
                     ]
                 }
             },
@@ -112,6 +113,7 @@ def hybrid_search(query, es, index_name, model_id, start_date, end_date):
                     "must": must_conditions
                 }
             },
+            "_source": RESULT_FIELDS,
             "highlight": {
                 "fields": {
                     "clinical_note": {},
@@ -121,6 +123,9 @@ def hybrid_search(query, es, index_name, model_id, start_date, end_date):
                 }
             }
         }
+        rescore = pruned_tokens_rescore(es, model_id, query, pruning)
+        if rescore:
+            body["rescore"] = rescore
         response = es.search(index=index_name, body=body)
         return process_results(response, include_highlights=True)
     except Exception as e:
@@ -146,30 +151,35 @@ def process_results(response, include_highlights=False):
         results.append(result)
     return results
 
-def rrf_search(query, es, index_name, start_date, end_date):
+def rrf_search(query, es, index_name, model_id, start_date, end_date, pruning=None, rank_window_size=RRF_RANK_WINDOW_SIZE, rank_constant=RRF_RANK_CONSTANT):
     try:
-        # Implement your RRF search logic here
-        # For now, we'll use a basic text search as a placeholder
+        # BM25 and ELSER scores are on unrelated scales, so rather than adding them up the two result lists
+        # are fused by rank on the server. Each retriever keeps the note_date filter.
+        date_filter = {"range": {"note_date": {"gte": start_date.isoformat(), "lte": end_date.isoformat()}}}
+        bm25_query = {
+            "multi_match": {
+                "query": query,
+                "fields": ["clinical_note^3", "condition^2", "patient_name", "gp"],
+                "type": "best_fields",
+                "fuzziness": "AUTO"
+            }
+        }
         body = {
-            "query": {
-                "bool": {
-                    "must": [
-                        {"match": {"clinical_note": query}},
-                        {"range": {"note_date": {"gte": start_date.isoformat(), "lte": end_date.isoformat()}}}
-                    ]
+            "retriever": {
+                "rrf": {
+                    "retrievers": [
+                        {"standard": {"query": {"bool": {"must": bm25_query, "filter": date_filter}}}},
+                        # The rrf retriever doesn't support rescore, so pruning applies without the rescore pass
+                        {"standard": {"query": {"bool": {"must": sparse_vector_query(es, model_id, query, pruning=pruning), "filter": date_filter}}}}
+                    ],
+                    "rank_window_size": rank_window_size,
+                    "rank_constant": rank_constant
                 }
             },
-            "highlight": {
-                "fields": {
-                    "clinical_note": {},
-                    "condition": {},
-                    "patient_name": {},
-                    "gp": {}
-                }
-            }
+            "_source": RESULT_FIELDS
         }
-        response = es.search(index=index_name, body=body, size=20)
-        return process_results(response, include_highlights=True)
+        response = es.search(index=index_name, body=body, size=min(20, rank_window_size))
+        return process_results(response)
     except Exception as e:
         print(f"Error performing RRF Search: {str(e)}")
         return []  # Return an empty list in case of error
@@ -1,94 +1,141 @@
-from elasticsearch.exceptions import RequestError
-import os, re, json, requests
-from dotenv import load_dotenv
+import re
+from concurrent.futures import ThreadPoolExecutor
+from inference_cache import inference_cache
 
-load_dotenv()
+ZERO_SHOT_CATEGORIES = ["Healthcare", "Technology", "Finance", "Education"]
 
-ELASTIC_URL = os.getenv("ELASTIC_URL")
-API_KEY = os.getenv("API_KEY")
+# Texts sent per _infer request; larger batches amortise the round trip but each request must finish within INFER_TIMEOUT
+INFER_BATCH_SIZE = 32
+INFER_TIMEOUT = "60s"
+
+ALL_ANALYSES = "All Analyses"
 
 def perform_text_analysis(analysis_type, text, es, model):
-    if analysis_type == "Named Entity Recognition":
-        return named_entity_recognition(text, model)
+    # For ALL_ANALYSES, model maps each analysis type to its model id
+    if analysis_type == ALL_ANALYSES:
+        return all_analyses(text, es, model)
+    elif analysis_type == "Named Entity Recognition":
+        return named_entity_recognition(text, es, model)
     elif analysis_type == "Sentiment Analysis":
-        return sentiment_analysis(text, model)
+        return sentiment_analysis(text, es, model)
     elif analysis_type == "Zero Shot Recognition":
-        return zero_shot_recognition(text, model)
+        return zero_shot_recognition(text, es, model)
     else:
         return "Invalid analysis type"
 
-def named_entity_recognition(text, ner_model):
+def all_analyses(text, es, models):
+    # The models run on separate ML deployments, so asking them at the same time costs the slowest one, not the sum
+    with ThreadPoolExecutor(max_workers=len(models)) as executor:
+        futures = [executor.submit(perform_text_analysis, analysis_type, text, es, model) for analysis_type, model in models.items()]
+        return "\n\n".join(future.result() for future in futures)
+
+def analyze_many(analysis_type, texts, es, model, batch_size=INFER_BATCH_SIZE):
+    # Batch counterpart of perform_text_analysis: one formatted result per text, in order
+    if analysis_type == ALL_ANALYSES:
+        with ThreadPoolExecutor(max_workers=len(model)) as executor:
+            futures = [executor.submit(analyze_many, name, texts, es, model_id, batch_size) for name, model_id in model.items()]
+            per_model = [future.result() for future in futures]
+        return ["\n\n".join(results) for results in zip(*per_model)]
+    formatters = {
+        "Named Entity Recognition": (format_named_entities, None),
+        "Sentiment Analysis": (format_sentiment, None),
+        "Zero Shot Recognition": (format_zero_shot, ZERO_SHOT_CATEGORIES)
+    }
+    if analysis_type not in formatters:
+        return ["Invalid analysis type"] * len(texts)
+    formatter, labels = formatters[analysis_type]
     try:
-        result = infer_zeroshot(ELASTIC_URL, API_KEY, ner_model, text)
-        predicted_value = result.get("predicted_value", "")
-        
-        # Replace entity tags with icons, removing brackets and repeated text
-        predicted_value = re.sub(r'\[([^\]]+)\]\(PER&[^)]+\)', r'\1 👤', predicted_value)
-        predicted_value = re.sub(r'\[([^\]]+)\]\(LOC&[^)]+\)', r'\1 🌎', predicted_value)
-        predicted_value = re.sub(r'\[([^\]]+)\]\(ORG&[^)]+\)', r'\1 🏢', predicted_value)
-        
-        formatted_result = f"Named Entities:\n{predicted_value}"
-        return formatted_result
+        inference_results = infer_batch(es, model, texts, labels, batch_size)
     except Exception as e:
-        return f"Error performing Named Entity Recognition: {str(e)}"
+        return [f"Error performing {analysis_type}: {str(e)}"] * len(texts)
 
-def infer_zeroshot(elastic_url, api_key, model_id, input_text, labels=None):
-    endpoint = f"{elastic_url}/_ml/trained_models/{model_id}/_infer"
-    payload = {
-        "docs": [
-            {
-                "text_field": input_text
-            }
-        ]
-    }
-    if labels:
-        payload["inference_config"] = {
-            "classification": {
-                "num_top_classes": len(labels),
-                "labels": labels
-            }
-        }
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"ApiKey {api_key}"
+    formatted_results = []
+    for result in inference_results:
+        # A text the model can't handle comes back with a warning instead of failing the batch
+        try:
+            formatted_results.append(formatter(result))
+        except Exception as e:
+            formatted_results.append(f"Error performing {analysis_type}: {result.get('warning', str(e))}")
+    return formatted_results
+
+def infer_batch(es, model_id, texts, labels=None, batch_size=INFER_BATCH_SIZE, cache=inference_cache):
+    # Uses the app's Elasticsearch client, so requests share its pooled keep-alive connections,
+    # and sends up to batch_size texts per _infer call. Texts already in the cache skip the ML node.
+    inference_config = {"zero_shot_classification": {"labels": labels}} if labels else None
+    results = [None] * len(texts)
+    missing = []
+    for position, text in enumerate(texts):
+        cached = cache.get(cache.key(model_id, text, labels)) if cache is not None else None
+        if cached is None:
+            missing.append(position)
+        else:
+            results[position] = cached
+
+    for start in range(0, len(missing), batch_size):
+        positions = missing[start:start + batch_size]
+        docs = [{"text_field": texts[position]} for position in positions]
+        response = es.ml.infer_trained_model(model_id=model_id, docs=docs, inference_config=inference_config, timeout=INFER_TIMEOUT)
+        for position, result in zip(positions, response["inference_results"]):
+            results[position] = result
+            if cache is not None and "warning" not in result:
+                cache.set(cache.key(model_id, texts[position], labels), result)
+    return results
+
+def format_named_entities(result):
+    predicted_value = result.get("predicted_value", "")
+
+    # Replace entity tags with icons, removing brackets and repeated text
+    predicted_value = re.sub(r'\[([^\]]+)\]\(PER&[^)]+\)', r'\1 👤', predicted_value)
+    predicted_value = re.sub(r'\[([^\]]+)\]\(LOC&[^)]+\)', r'\1 🌎', predicted_value)
+    predicted_value = re.sub(r'\[([^\]]+)\]\(ORG&[^)]+\)', r'\1 🏢', predicted_value)
+
+    formatted_result = f"Named Entities:\n{predicted_value}"
+    return formatted_result
+
+def format_sentiment(result):
+    predicted_label = result.get("predicted_value")
+    prediction_probability = result.get("prediction_probability", 0)
+
+    sentiment_emoji = {
+        "positive": "😊",
+        "negative": "😞",
+        "neutral": "😐"
     }
-    response = requests.post(endpoint, json=payload, headers=headers)
-    response.raise_for_status()
-    return response.json()["inference_results"][0]
 
-def sentiment_analysis(text, sentiment_model):
+    emoji = sentiment_emoji.get(predicted_label.lower(), "")
+
+    formatted_result = f"Sentiment: {predicted_label} {emoji}\n"
+    formatted_result += f"Confidence: {prediction_probability:.2f}"
+    return formatted_result
+
+def format_zero_shot(result):
+    # Zero-shot models return every label under top_classes
+    predictions = [(c["class_name"], c["class_probability"]) for c in result.get("top_classes", [])]
+    predictions = predictions or [(p["label"], p["score"]) for p in result.get("prediction", [])]
+
+    # Sort predictions by score in descending order
+    sorted_predictions = sorted(predictions, key=lambda x: x[1], reverse=True)
+
+    formatted_result = "Zero-shot Classification Results:\n"
+    for label, score in sorted_predictions:
+        formatted_result += f"{label}: {score:.2f}\n"
+
+    return formatted_result
+
+def named_entity_recognition(text, es, ner_model):
+    try:
+        return format_named_entities(infer_batch(es, ner_model, [text])[0])
+    except Exception as e:
+        return f"Error performing Named Entity Recognition: {str(e)}"
+
+def sentiment_analysis(text, es, sentiment_model):
     try:
-        result = infer_zeroshot(ELASTIC_URL, API_KEY, sentiment_model, text)
-        predicted_label = result.get("predicted_value")
-        prediction_probability = result.get("prediction_probability", 0)
-        
-        sentiment_emoji = {
-            "positive": "😊",
-            "negative": "😞",
-            "neutral": "😐"
-        }
-        
-        emoji = sentiment_emoji.get(predicted_label.lower(), "")
-        
-        formatted_result = f"Sentiment: {predicted_label} {emoji}\n"
-        formatted_result += f"Confidence: {prediction_probability:.2f}"
-        return formatted_result
+        return format_sentiment(infer_batch(es, sentiment_model, [text])[0])
     except Exception as e:
         return f"Error performing Sentiment Analysis: {str(e)}"
 
-def zero_shot_recognition(text, zero_shot_model):
-    categories = ["Healthcare", "Technology", "Finance", "Education"]
+def zero_shot_recognition(text, es, zero_shot_model):
     try:
-        result = infer_zeroshot(ELASTIC_URL, API_KEY, zero_shot_model, text, categories)
-        predictions = result.get("prediction", [])
-        
-        # Sort predictions by score in descending order
-        sorted_predictions = sorted(predictions, key=lambda x: x['score'], reverse=True)
-        
-        formatted_result = "Zero-shot Classification Results:\n"
-        for pred in sorted_predictions:
-            formatted_result += f"{pred['label']}: {pred['score']:.2f}\n"
-        
-        return formatted_result
+        return format_zero_shot(infer_batch(es, zero_shot_model, [text], ZERO_SHOT_CATEGORIES)[0])
     except Exception as e:
         return f"Error performing Zero Shot Recognition: {str(e)}"